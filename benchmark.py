@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the scripts in this repo against a synthetic corpus of python files.
+
+    ./benchmark.py --files 500 --save-baseline
+    # ... change something ...
+    ./benchmark.py --files 500
+
+The corpus is generated from a fixed seed, so it's the same every time. It contains
+the constructs each script looks for (%-interpolation, .format(), xunit asserts,
+super(X, self), dict([...]), bytes literals), mixed with code that none of them touch.
+
+Each script (and then all of them together) is run over a fresh copy of the corpus,
+and the time spent reading, parsing, matching, modifying, diffing and writing is
+reported. If there's a baseline for the same corpus, the output is compared to the
+output recorded there, and throughput drops of more than --tolerance are flagged.
+
+Before that, each script (and all of them together) is applied to a copy of each
+block, and the results are checked against EXPECTED_BLOCKS, whatever the baseline
+says.
+
+Each run is also tried on testfile.py with --until-stable, which should settle
+without errors.
+
+Finally, the startup time of each decrapify.py command is measured, by running it
+on a tiny file in a fresh interpreter.
+"""
+
+import argparse
+import difflib
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import decrapify
+
+# Beside the pattern cache, rather than in the repo
+BASELINE_FILE = os.path.join(decrapify.CACHE_DIR, 'benchmark_baseline.json')
+DECRAPIFY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decrapify.py')
+TESTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testfile.py')
+
+# Things that at least one of the scripts should change.
+# `{n}` is replaced with a number, to keep names unique.
+INTERESTING_BLOCKS = [
+    '''
+class Thing{n}(object):
+    def __init__(self, name{n}):
+        super(Thing{n}, self).__init__()
+        self.label = 'thing %s' % name{n}
+        self.pair = '%s and %d' % (name{n}, count{n})
+''',
+    '''
+def describe{n}(first{n}, second{n}):
+    summary = '{{}} then {{}}'.format(first{n}, second{n})
+    detail = 'first={{first}}'.format(first=first{n})
+    return summary, detail
+''',
+    '''
+class Thing{n}Tests(unittest.TestCase):
+    def test_thing{n}(self):
+        self.assertEqual(value{n}, 'expected')
+        self.assertNotEqual(value{n}, other{n})
+        self.assertTrue(flag{n})
+        self.assertIsNone(missing{n})
+        self.assertIn(key{n}, mapping{n})
+        with self.assertRaises(ValueError):
+            explode{n}()
+''',
+    '''
+def lookup{n}(pairs{n}):
+    table = dict([(k, v) for k, v in pairs{n}])
+    if not table == expected{n}:
+        return None
+    return table
+''',
+    '''
+HEADER{n} = b'MAGIC{n}'
+TRAILER{n} = b"END"
+''',
+    '''
+class Named{n}(object):
+    def __unicode__(self):
+        return self.name{n}
+''',
+]
+
+# Things none of the scripts should care about.
+BORING_BLOCKS = [
+    '''
+def add{n}(a, b):
+    total = a + b
+    return total * {n}
+''',
+    '''
+VALUES{n} = [1, 2, 3, {n}]
+NAMES{n} = ['alpha', 'beta', 'gamma']
+''',
+    '''
+class Plain{n}:
+    size = {n}
+
+    def grow(self, amount):
+        self.size += amount
+        return self.size
+''',
+]
+
+# What each of INTERESTING_BLOCKS (with n=1) should become, with each script that
+# changes it, and with all of them. Anything not listed here, including all of
+# BORING_BLOCKS, should be left alone. This is checked on every run, whatever
+# the baseline says.
+EXPECTED_BLOCKS = [
+    {
+        'fstrings': '''
+class Thing1(object):
+    def __init__(self, name1):
+        super(Thing1, self).__init__()
+        self.label = f'thing {name1}'
+        self.pair = f'{name1} and {count1}'
+''',
+        'py3cleanup': '''
+class Thing1:
+    def __init__(self, name1):
+        super().__init__()
+        self.label = 'thing %s' % name1
+        self.pair = '%s and %d' % (name1, count1)
+''',
+        'all': '''
+class Thing1:
+    def __init__(self, name1):
+        super().__init__()
+        self.label = f'thing {name1}'
+        self.pair = f'{name1} and {count1}'
+''',
+    },
+    {
+        'fstrings': '''
+def describe1(first1, second1):
+    summary = f'{first1} then {second1}'
+    detail = f'first={first1}'
+    return summary, detail
+''',
+        'all': '''
+def describe1(first1, second1):
+    summary = f'{first1} then {second1}'
+    detail = f'first={first1}'
+    return summary, detail
+''',
+    },
+    {
+        'pytestify': '''import pytest
+
+class Thing1Tests(unittest.TestCase):
+    def test_thing1(self):
+        assert value1 == 'expected'
+        assert value1 != other1
+        assert flag1
+        assert missing1 is None
+        assert key1 in mapping1
+        with pytest.raises(ValueError):
+            explode1()
+''',
+        'all': '''import pytest
+
+class Thing1Tests(unittest.TestCase):
+    def test_thing1(self):
+        assert value1 == 'expected'
+        assert value1 != other1
+        assert flag1
+        assert missing1 is None
+        assert key1 in mapping1
+        with pytest.raises(ValueError):
+            explode1()
+''',
+    },
+    {
+        'obvious_cleanup': '''
+def lookup1(pairs1):
+    table = {k: v for k, v in pairs1}
+    if table != expected1:
+        return None
+    return table
+''',
+        'all': '''
+def lookup1(pairs1):
+    table = {k: v for k, v in pairs1}
+    if table != expected1:
+        return None
+    return table
+''',
+    },
+    {
+        'debytesify': '''
+HEADER1 = 'MAGIC1'
+TRAILER1 = "END"
+''',
+        'all': '''
+HEADER1 = 'MAGIC1'
+TRAILER1 = "END"
+''',
+    },
+    {
+        'py3cleanup': '''
+class Named1:
+    def __unicode__(self):
+        return self.name1
+''',
+        'sixify': '''import six
+
+@six.python_2_unicode_compatible
+class Named1(object):
+    def __str__(self):
+        return self.name1
+''',
+        'all': '''import six
+
+@six.python_2_unicode_compatible
+class Named1:
+    def __str__(self):
+        return self.name1
+''',
+    },
+]
+
+
+def generate_corpus(directory, num_files, blocks_per_file, seed):
+    """
+    Writes `num_files` python files into `directory`.
+
+    About half the files contain nothing any of the scripts would change.
+    """
+    rng = random.Random(seed)
+    n = 0
+    for i in range(num_files):
+        boring_only = rng.random() < 0.5
+        blocks = ['import unittest\n']
+        for _ in range(blocks_per_file):
+            n += 1
+            if boring_only or rng.random() < 0.3:
+                template = rng.choice(BORING_BLOCKS)
+            else:
+                template = rng.choice(INTERESTING_BLOCKS)
+            blocks.append(template.format(n=n))
+
+        subdirectory = os.path.join(directory, f'package{i % 10}')
+        os.makedirs(subdirectory, exist_ok=True)
+        with open(os.path.join(subdirectory, f'module{i}.py'), 'w') as f:
+            f.write(''.join(blocks))
+
+
+def digest_tree(directory):
+    """
+    Returns a hash of the names and contents of all the files in `directory`.
+    """
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in sorted(os.walk(directory)):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, directory).encode() + b'\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def count_lines(directory):
+    lines = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                lines += f.read().count(b'\n')
+    return lines
+
+
+def benchmark(name, fixer_names, corpus, workdir, jobs):
+    """
+    Runs the given scripts over a fresh copy of the corpus, writing the changes.
+    """
+    target = os.path.join(workdir, name)
+    shutil.copytree(corpus, target)
+
+    tool = decrapify.build_tool(
+        fixer_names,
+        {'debug': False, 'skip_multiline_expressions': False},
+        prefilter=True,
+        interactive=False,
+        write=True,
+        silent=True,
+        jobs=jobs,
+    )
+    start = time.perf_counter()
+    tool.run([target])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'phases': {phase: tool.timings[phase] for phase in tool.PHASES},
+        'errors': len(tool.exceptions),
+        'digest': digest_tree(target),
+    }
+
+
+def check_expected(workdir):
+    """
+    Applies each script (and then all of them) to a file of each block, and
+    returns a list of the differences from EXPECTED_BLOCKS.
+    """
+    blocks = [template.format(n=1) for template in INTERESTING_BLOCKS + BORING_BLOCKS]
+    expected = EXPECTED_BLOCKS + [{}] * len(BORING_BLOCKS)
+    runs = [(name, [name]) for name in decrapify.FIXERS]
+    runs.append(('all', list(decrapify.FIXERS)))
+
+    problems = []
+    for name, fixer_names in runs:
+        directory = os.path.join(workdir, f'{name}-expected')
+        os.makedirs(directory)
+        for i, block in enumerate(blocks):
+            with open(os.path.join(directory, f'block{i}.py'), 'w') as f:
+                f.write(block)
+
+        tool = decrapify.build_tool(
+            fixer_names,
+            {'debug': False, 'skip_multiline_expressions': False},
+            interactive=False,
+            write=True,
+            silent=True,
+        )
+        tool.run([directory])
+
+        for i, block in enumerate(blocks):
+            with open(os.path.join(directory, f'block{i}.py')) as f:
+                output = f.read()
+            wanted = expected[i].get(name, block)
+            if output != wanted:
+                diff = difflib.unified_diff(
+                    wanted.splitlines(keepends=True),
+                    output.splitlines(keepends=True),
+                    'expected',
+                    'actual',
+                )
+                problems.append(
+                    f"{name}: block {i} isn't changed as expected:\n{''.join(diff)}"
+                )
+    return problems
+
+
+def check_until_stable(name, fixer_names, workdir):
+    """
+    Runs the given scripts over a copy of testfile.py with --until-stable.
+    Returns a list of problems.
+    """
+    directory = os.path.join(workdir, f'{name}-stable')
+    os.makedirs(directory)
+    shutil.copy(TESTFILE, directory)
+
+    tool = decrapify.build_tool(
+        fixer_names,
+        {'debug': False, 'skip_multiline_expressions': False},
+        interactive=False,
+        write=True,
+        silent=True,
+        until_stable=True,
+    )
+    tool.run([directory])
+
+    problems = [f"{name}: testfile.py failed: {exc}" for exc in tool.exceptions]
+    if any(stat.startswith('still changing') for stat in tool.stats):
+        problems.append(f"{name}: testfile.py is still changing with --until-stable")
+    return problems
+
+
+def measure_startup(command, workdir, runs):
+    """
+    Returns the fastest of several runs of a decrapify.py command over a tiny file.
+
+    The file isn't pre-filtered, so everything needed to process it gets loaded.
+    """
+    filename = os.path.join(workdir, 'startup.py')
+    with open(filename, 'w') as f:
+        f.write('x = 1\n')
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                DECRAPIFY,
+                *command,
+                '--no-prefilter',
+                '--no-input',
+                '--no-write',
+                filename,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the scripts against a synthetic corpus."
+    )
+    parser.add_argument(
+        '--files', type=int, default=200, help="Number of files in the corpus"
+    )
+    parser.add_argument(
+        '--blocks',
+        type=int,
+        default=20,
+        help="Number of chunks of code (classes, functions etc) in each file",
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0, help="Seed for generating the corpus"
+    )
+    parser.add_argument(
+        '-f',
+        '--fixer',
+        dest='fixers',
+        action='append',
+        choices=decrapify.FIXERS,
+        help="Only benchmark these scripts (default: each one, then all together)",
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help="Passed on to decrapify.py"
+    )
+    parser.add_argument(
+        '--baseline',
+        default=BASELINE_FILE,
+        help=f"Where the baseline results are kept (default: {BASELINE_FILE})",
+    )
+    parser.add_argument(
+        '--save-baseline',
+        default=False,
+        action='store_true',
+        help="Record these results as the new baseline",
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help="How much slower than the baseline (0.2 = 20%%) counts as a regression",
+    )
+    parser.add_argument(
+        '--startup-runs',
+        type=int,
+        default=5,
+        help="How many times to run each command when measuring startup (0 to skip)",
+    )
+    args = parser.parse_args()
+
+    # Failures are counted in the results; we don't need all the tracebacks.
+    logging.disable(logging.ERROR)
+
+    fixer_names = args.fixers or list(decrapify.FIXERS)
+    runs = [(name, [name]) for name in fixer_names]
+    if len(runs) > 1:
+        runs.append(('all', fixer_names))
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    corpus_key = f'files={args.files},blocks={args.blocks},seed={args.seed}'
+    baseline = baselines.get(corpus_key, {})
+
+    problems = []
+    with tempfile.TemporaryDirectory() as workdir:
+        problems.extend(check_expected(workdir))
+
+        corpus = os.path.join(workdir, 'corpus')
+        generate_corpus(corpus, args.files, args.blocks, args.seed)
+        lines = count_lines(corpus)
+        print(f"Corpus: {args.files} files, {lines} lines ({corpus_key})")
+        print()
+
+        phases = decrapify.DecrapifyTool.PHASES
+        columns = ['total', *phases, 'files/s', 'errors']
+        print(f"{'':20}" + ''.join(f'{c:>9}' for c in columns))
+
+        for name, fixers in runs:
+            result = benchmark(name, fixers, corpus, workdir, args.jobs)
+            result['files_per_second'] = args.files / result['seconds']
+
+            print(
+                f'{name:20}'
+                + f"{result['seconds']:9.2f}"
+                + ''.join(f"{result['phases'][phase]:9.2f}" for phase in phases)
+                + f"{result['files_per_second']:9.1f}"
+                + f"{result['errors']:9}"
+            )
+
+            previous = baseline.get(name)
+            if previous is not None:
+                if previous['digest'] != result['digest']:
+                    problems.append(f"{name}: output differs from the baseline")
+                slowest = previous['files_per_second'] * (1 - args.tolerance)
+                if result['files_per_second'] < slowest:
+                    problems.append(
+                        f"{name}: {result['files_per_second']:.1f} files/s is much "
+                        f"slower than the baseline's {previous['files_per_second']:.1f}"
+                    )
+            baseline[name] = result
+            problems.extend(check_until_stable(name, fixers, workdir))
+
+        if args.startup_runs:
+            print()
+            print(f"Startup time (best of {args.startup_runs}):")
+            commands = [(name, [name]) for name in fixer_names]
+            if len(fixer_names) > 1:
+                commands.append(
+                    ('run (all)', ['run', *(f'--fixer={name}' for name in fixer_names)])
+                )
+            for name, command in commands:
+                seconds = measure_startup(command, workdir, args.startup_runs)
+                print(f'{name:20}{seconds:9.2f}')
+
+    print()
+    if args.save_baseline:
+        baselines[corpus_key] = baseline
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.baseline}")
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,102 @@
 #!/usr/bin/env python3
 """
 Removes bytestring literals. Be careful with this!
+
+When it's the only script being applied, decrapify.py uses transform_source()
+instead of the selector, which works on the tokens rather than a whole tree.
 """
 
 import argparse
+import io
+import re
+import tokenize
 
 from bowler import Query, TOKEN
 from bowler.types import Leaf
 
 flags = {}
 
+# The start of a bytes literal
+PREFILTER = re.compile(rb'(?<!\w)(?:[bB][rR]?|[rR][bB])[\'"]')
 
-def debytesify(node, capture, arguments):
-    i = 0
-    for i, char in enumerate(node.value):
+
+# Only in python 3.12+, where f-strings are split into several tokens
+FSTRING_START = getattr(tokenize, 'FSTRING_START', None)
+FSTRING_END = getattr(tokenize, 'FSTRING_END', None)
+
+
+def remove_bytes_prefix(literal):
+    """
+    Returns a string literal without its b prefix, or None if it hasn't got one.
+    """
+    for i, char in enumerate(literal):
         if char in ('"', "'"):
-            return
-        elif char == 'b':
-            break
+            return None
+        elif char in ('b', 'B'):
+            return literal[:i] + literal[i + 1 :]
+    return None
+
 
-    value = node.value[:i] + node.value[i + 1 :]
+def debytesify(node, capture, arguments):
+    value = remove_bytes_prefix(node.value)
+    if value is None:
+        return
     new_node = Leaf(TOKEN.STRING, value, prefix=node.prefix)
     node.replace(new_node)
 
 
+def transform_source(source):
+    """
+    Does the same as the selector and modifier, to some source code (a str),
+    without parsing it: each bytes literal found by the tokenizer has its prefix
+    removed, and everything else is left exactly as it was.
+
+    Returns the new source, or None if it couldn't be tokenized.
+    """
+    line_starts = [0]
+    for line in io.StringIO(source):
+        line_starts.append(line_starts[-1] + len(line))
+
+    pieces = []
+    copied_up_to = 0
+    fstring_depth = 0
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            if token.type == FSTRING_START:
+                fstring_depth += 1
+            elif token.type == FSTRING_END:
+                fstring_depth -= 1
+            # fissix sees a whole f-string as one string, so leave what's inside alone
+            if token.type != tokenize.STRING or fstring_depth:
+                continue
+            value = remove_bytes_prefix(token.string)
+            if value is None:
+                continue
+            start = line_starts[token.start[0] - 1] + token.start[1]
+            pieces.append(source[copied_up_to:start])
+            pieces.append(value)
+            copied_up_to = start + len(token.string)
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    pieces.append(source[copied_up_to:])
+    return ''.join(pieces)
+
+
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
+        .select(
+            """
+            STRING
+            """
+        )
+        .modify(callback=debytesify)
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Removes bytestring literals. Be careful with this!"
@@ -59,13 +132,7 @@ def main():
 
     (
         # Look for files in the current working directory
-        Query(*args.files)
-        .select(
-            """
-            STRING
-            """
-        )
-        .modify(callback=debytesify)
+        add_transforms(Query(*args.files))
         # Actually run all of the above.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
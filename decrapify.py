@@ -0,0 +1,3223 @@
+#!/usr/bin/env python3
+"""
+Runs several of the other scripts in this repo over your code in one go.
+
+Each file is only read and parsed once. The selectors and modifiers of every
+chosen script are applied to the same tree, so you get one combined diff
+(and at most one write) per file, instead of one per script:
+
+    ./decrapify.py run --fixer fstrings --fixer py3cleanup mymodule.py
+
+Each script can also be run on its own, e.g. `./decrapify.py fstrings mymodule.py`.
+Only the scripts being applied are imported.
+"""
+
+import argparse
+import difflib
+import fnmatch
+import hashlib
+import importlib
+import io
+import json
+import logging
+import math
+import os
+import pickle
+import re
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tokenize
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+from itertools import chain, islice
+
+import bowler
+import fissix
+from bowler import Query
+from bowler.tool import BowlerTool
+from bowler.types import BadTransform, BowlerException, BowlerQuit
+from fissix import pygram, pytree
+from fissix.patcomp import PatternCompiler
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'decrapify'
+)
+
+# The scripts which can be combined. Regardless of the order they're given on the
+# command line, their selectors are tried in this order on each node. But they're
+# all applied in the same (post-order) walk over the tree, so a script can see
+# what a later one has done inside the node it's looking at: e.g. debytesify
+# takes the `b` off `b"{x}"` before fstrings gets to `b"{x}".format(x=x)`.
+FIXERS = (
+    'fstrings',
+    'pytestify',
+    'obvious_cleanup',
+    'py3cleanup',
+    'sixify',
+    'debytesify',
+)
+
+
+def load_fixers(names):
+    """
+    Imports the scripts with the given names, in the order they should be applied.
+    """
+    return [importlib.import_module(name) for name in FIXERS if name in names]
+
+
+def add_transforms(query, fixers):
+    """
+    Adds the selectors and modifiers from all the given scripts to one bowler Query.
+    """
+    for fixer in fixers:
+        query = fixer.add_transforms(query)
+    return query
+
+
+def rule_name(transform):
+    """
+    Returns the name of a selector (a rule, for --enable/--disable), which is
+    the name of its callbacks.
+    """
+    return '/'.join(callback.__name__ for callback in transform.callbacks)
+
+
+def rule_names(fixer):
+    """
+    Returns the names of a script's rules: its selectors, each followed by the
+    parts of it which can be enabled separately (see RULE_PARTS in pytestify.py)
+    as 'selector:part'.
+    """
+    parts = getattr(fixer, 'RULE_PARTS', {})
+    names = []
+    for transform in fixer.add_transforms(Query()).transforms:
+        name = rule_name(transform)
+        names.append(name)
+        names.extend(f'{name}:{part}' for part in parts.get(name, ()))
+    return names
+
+
+def enabled_rules(names, enable=None, disable=()):
+    """
+    Returns which of the given rules (see rule_names()) are enabled, given the
+    names to --enable (or None for all of them) and --disable.
+
+    Enabling or disabling a selector does the same to all of its parts, and a
+    selector with parts is enabled if any of them are.
+    """
+
+    def is_enabled(name):
+        selector = name.split(':')[0]
+        return (enable is None or name in enable or selector in enable) and not (
+            name in disable or selector in disable
+        )
+
+    with_parts = {name.split(':')[0] for name in names if ':' in name}
+    with_enabled_parts = {
+        name.split(':')[0] for name in names if ':' in name and is_enabled(name)
+    }
+    return [
+        name
+        for name in names
+        if (name in with_enabled_parts if name in with_parts else is_enabled(name))
+    ]
+
+
+def in_rule_parts(fixer, selector, rules):
+    """
+    Returns a filter for one of a script's selectors, which only lets through
+    the matches for the parts of it (see rule_names()) which are in `rules`.
+    """
+    parts = {
+        part for part in fixer.RULE_PARTS[selector] if f'{selector}:{part}' in rules
+    }
+
+    def in_enabled_parts(node, capture, filename):
+        return fixer.rule_part(node, capture) in parts
+
+    return in_enabled_parts
+
+
+def combine_prefilters(fixers):
+    """
+    Combines the PREFILTER regexes of the given scripts into one.
+
+    If a file doesn't match it, none of the scripts could change anything in it,
+    so we don't need to parse it at all.
+    """
+    return re.compile(
+        b'|'.join(b'(?:%s)' % fixer.PREFILTER.pattern for fixer in fixers)
+    )
+
+
+def git(*args):
+    """
+    Runs a git command, returning its output as bytes.
+    """
+    return subprocess.run(
+        ['git', *args], check=True, stdout=subprocess.PIPE
+    ).stdout
+
+
+def git_diff_args(since=None, staged=False):
+    """
+    The `git diff` arguments to compare the working tree (or the index, if `staged`)
+    to `since` (or to the index/HEAD if not given).
+    """
+    args = ['diff', '--relative', '--no-ext-diff', '--no-color', '--diff-filter=d']
+    if staged:
+        args.append('--cached')
+    if since:
+        args.append(since)
+    return args
+
+
+def git_changed_files(paths=(), since=None, staged=False):
+    """
+    Lists the files which have changed, relative to the current directory.
+    """
+    output = git(*git_diff_args(since, staged), '--name-only', '-z', '--', *paths)
+    return [os.fsdecode(name) for name in output.split(b'\0') if name]
+
+
+RE_HUNK_HEADER = re.compile(rb'^@@ -\S+ \+(\d+)(?:,(\d+))? @@')
+RE_OLD_RANGE = re.compile(r'^@@ -(\d+)(?:,(\d+))? ')
+
+
+def git_changed_lines(paths=(), since=None, staged=False):
+    """
+    Finds which lines have changed in each file.
+
+    Returns a dict mapping filenames to lists of (first, last) line numbers,
+    in the new version of the file.
+    """
+    output = git(*git_diff_args(since, staged), '-U0', '--no-prefix', '--', *paths)
+    changed_lines = {}
+    lines = None
+    for line in output.splitlines():
+        if line.startswith(b'+++ '):
+            lines = changed_lines.setdefault(os.fsdecode(line[4:]), [])
+            continue
+        match = RE_HUNK_HEADER.match(line)
+        if match and lines is not None:
+            first = int(match.group(1))
+            count = 1 if match.group(2) is None else int(match.group(2))
+            if count:
+                lines.append((first, first + count - 1))
+    return changed_lines
+
+
+def node_lines(node):
+    """
+    Returns the (first, last) line numbers of a node, not counting its prefix.
+    """
+    leaves = list(node.leaves()) or [node]
+    # Not the NEWLINE, INDENT and DEDENT tokens, which end lines rather than
+    # being on them (and a DEDENT's line is that of the next statement)
+    code = [leaf for leaf in leaves if leaf.value.strip()] or leaves
+    last = code[-1]
+    return code[0].lineno, last.lineno + last.value.count('\n')
+
+
+def release_tree(tree):
+    """
+    Breaks up a tree we've finished with, so its memory is freed right away.
+
+    Every node refers to its parent and its parent to it, so otherwise it would hang
+    around until the next full garbage collection, which is rare in a long run.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        node.parent = None
+        if node.children:
+            stack.extend(node.children)
+            node.children = []
+
+
+def forget_traceback(exc):
+    """
+    Drops the tracebacks of an exception (and its causes), which we've already
+    logged. They refer to the frames, and so to the tree, of the failed file.
+    """
+    while exc is not None:
+        exc.__traceback__ = None
+        exc = exc.__cause__ or exc.__context__
+
+
+def current_rss():
+    """
+    Returns this process's resident memory in bytes, or 0 if we can't tell.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # This is the peak rather than the current size, but it's the best we've got
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def read_file_list(f):
+    """
+    Yields the filenames in a NUL-delimited list (e.g. from `find -print0`),
+    without reading the whole list first.
+    """
+    remainder = b''
+    while True:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            break
+        *names, remainder = (remainder + chunk).split(b'\0')
+        for name in names:
+            if name:
+                yield os.fsdecode(name)
+    # Tolerate a trailing newline, e.g. from `echo`
+    remainder = remainder.rstrip(b'\n')
+    if remainder:
+        yield os.fsdecode(remainder)
+
+
+def expand_arguments(items):
+    """
+    Yields the files and directories given on the command line.
+
+    `-` is replaced by the NUL-delimited list of names on stdin,
+    and `@FILE` by the NUL-delimited list of names in FILE.
+    """
+    for item in items:
+        if item == '-':
+            yield from read_file_list(sys.stdin.buffer)
+        elif item.startswith('@'):
+            with open(item[1:], 'rb') as f:
+                yield from read_file_list(f)
+        else:
+            yield item
+
+
+def format_patch(filename, hunks, old_content):
+    """
+    Formats a file's hunks (as accumulated by BowlerTool.process_hunks())
+    as a patch which `git apply` (or `patch -p1`) can apply. Returns bytes.
+    """
+    path = os.path.relpath(filename).replace(os.sep, '/')
+    # Not splitlines(), which would drop the '\r' of CRLF lines (and split on
+    # form feeds)
+    lines = split_lines(hunks)
+
+    if old_content and not old_content.endswith(b'\n'):
+        # Bowler diffs as if the file ended with a newline, and the new file is
+        # written without one too (see patch_text()). If the last hunk reaches the
+        # end of the file, that needs saying for both, or the patch won't apply
+        # (or would add a newline).
+        num_lines = old_content.count(b'\n') + 1
+        last_header = max(i for i, line in enumerate(lines) if line.startswith('@@'))
+        start, count = RE_OLD_RANGE.match(lines[last_header]).groups()
+        if int(start) + int(count or 1) - 1 == num_lines:
+            body = range(last_header + 1, len(lines))
+            last_old = max(i for i in body if lines[i][:1] in (' ', '-'))
+            last_new = max(
+                (i for i in body if lines[i][:1] in (' ', '+')), default=None
+            )
+            marker = '\\ No newline at end of file'
+            if last_new is None or last_new == last_old:
+                # The same line ends both (or nothing's left of the file)
+                lines.insert(last_old + 1, marker)
+            else:
+                # After the first of them, there are only lines of the other file.
+                # Give the rest of each file separately, each with its own marker.
+                first = min(last_old, last_new)
+                tail = lines[first:]
+                old = ['-' + line[1:] for line in tail if line[:1] in (' ', '-')]
+                new = ['+' + line[1:] for line in tail if line[:1] in (' ', '+')]
+                lines[first:] = old + [marker] + new + [marker]
+
+    # Keep the source file's encoding, so the patch applies to the bytes on disk.
+    encoding = tokenize.detect_encoding(io.BytesIO(old_content).readline)[0]
+    header = f'diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n'
+    body = ''.join(line + '\n' for line in lines)
+    return os.fsencode(header) + body.encode(encoding)
+
+
+def split_lines(text):
+    """
+    Splits text into lines, without their endings. Unlike str.splitlines(), only
+    '\n' ends a line, as far as the tokenizer and patch are concerned.
+    """
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def patch_text(text, hunks):
+    """
+    Applies a file's hunks (as accumulated by BowlerTool.process_hunks()) to the
+    text they were made from. Raises ValueError if they don't match it.
+    """
+    # Bowler diffs as if the file ended with a newline
+    missing_newline = not text.endswith('\n')
+    old_lines = (text + '\n' if missing_newline else text).split('\n')
+    new_lines = []
+    position = 0
+    # Not splitlines(), which splits on form feeds (and more) too
+    for line in hunks.split('\n'):
+        if not line:
+            continue
+        if line.startswith('@@'):
+            start, count = RE_OLD_RANGE.match(line).groups()
+            # An empty range is given as the line before it
+            start = int(start) if count == '0' else int(start) - 1
+            if start < position:
+                raise ValueError(f"hunks overlap at line {start + 1}")
+            new_lines.extend(old_lines[position:start])
+            position = start
+        elif line.startswith('+'):
+            new_lines.append(line[1:])
+        else:
+            if position >= len(old_lines) - 1 or old_lines[position] != line[1:]:
+                raise ValueError(f"line {position + 1} has changed")
+            if line.startswith(' '):
+                new_lines.append(line[1:])
+            position += 1
+    new_lines.extend(old_lines[position:])
+    new_text = '\n'.join(new_lines)
+    if missing_newline and new_text.endswith('\n'):
+        new_text = new_text[:-1]
+    return new_text
+
+
+def write_atomically(path, content, mode):
+    """
+    Writes bytes to a file via a temporary file beside it, which is then renamed
+    into place, so the file is never left half-written.
+    """
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(dir=directory or os.curdir, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temp, mode)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def split_patch(content):
+    """
+    Splits a patch written by --patch-out into the patches for each file.
+    Yields (path, patch) pairs, with the patches as bytes.
+    """
+    for patch in re.split(rb'^(?=diff --git )', content, flags=re.M):
+        if not patch:
+            continue
+        match = re.search(rb'^--- a/(.*)$', patch, flags=re.M)
+        if match is None:
+            raise ValueError(f"not a patch from --patch-out: {patch[:80]!r}")
+        yield os.fsdecode(match.group(1)), patch
+
+
+def split_report(content):
+    """
+    Splits a --report-jsonl report into the lines for each file.
+    Yields (path, lines) pairs, with the lines as bytes.
+    """
+    for line in content.splitlines(keepends=True):
+        if line.strip():
+            yield json.loads(line)['file'], line.rstrip(b'\n') + b'\n'
+
+
+def sync_files(paths):
+    """
+    Flushes files to disk, and the directories they're in, so their renames stick.
+    """
+    directories = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path) or os.curdir)
+    for directory in sorted(directories):
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            # Some platforms (e.g. Windows) can't open directories
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def translate_gitignore_pattern(pattern):
+    """
+    Converts a .gitignore pattern into a regex which matches paths
+    relative to the directory containing the .gitignore.
+    """
+    # A slash anywhere but the end means it's relative to the .gitignore;
+    # otherwise it can match at any depth.
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = '' if anchored else '(?:.*/)?'
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2 :]:
+            end = pattern.index(']', i + 2)
+            regex += '[' + pattern[i + 1 : end].replace('!', '^', 1) + ']'
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r'\Z')
+
+
+def read_gitignore(directory):
+    """
+    Returns the rules in `directory`/.gitignore, as
+    (directory, regex, negated, directories_only) tuples.
+    """
+    try:
+        with open(os.path.join(directory, '.gitignore'), encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return []
+
+    rules = []
+    for line in lines:
+        line = line.rstrip(' ')
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        if negated or line.startswith('\\'):
+            line = line[1:]
+        directories_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line:
+            regex = translate_gitignore_pattern(line)
+            rules.append((directory, regex, negated, directories_only))
+    return rules
+
+
+def inherited_gitignore_rules(directory):
+    """
+    Returns the .gitignore rules which apply to `directory` from its parents,
+    up to the top of the git repository it's in (if any).
+    """
+    directory = os.path.abspath(directory)
+    parents = []
+    while not os.path.exists(os.path.join(directory, '.git')):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            # Not in a git repository
+            return []
+        directory = parent
+        parents.append(directory)
+
+    rules = []
+    for parent in reversed(parents):
+        rules.extend(read_gitignore(parent))
+    return rules
+
+
+def is_ignored(path, is_dir, rules):
+    """
+    Whether the given .gitignore rules ignore a path. The last matching rule wins.
+    """
+    path = os.path.abspath(path)
+    for directory, regex, negated, directories_only in reversed(rules):
+        if directories_only and not is_dir:
+            continue
+        if regex.match(os.path.relpath(path, directory).replace(os.sep, '/')):
+            return not negated
+    return False
+
+
+def build_tool(
+    fixer_names,
+    flags,
+    prefilter=False,
+    staged=False,
+    changed_lines=None,
+    profile=False,
+    profile_stats=False,
+    report=False,
+    check=False,
+    timeout=None,
+    until_stable=False,
+    max_passes=10,
+    engine='auto',
+    rules=None,
+    count=False,
+    sample=None,
+    sample_seed=0,
+    **kwargs,
+):
+    """
+    Builds a DecrapifyTool which applies the named scripts.
+
+    `flags` is copied into each script's module-level `flags` dict.
+    If `rules` is given, only the selectors with those names (see rule_names())
+    are used, and the rest aren't even compiled; for selectors with parts, only
+    the matches for the parts named are changed.
+    If `prefilter` is true, files which obviously contain nothing to change are
+    skipped without being parsed.
+    If `staged` is true, the staged content of files is used instead of what's on disk.
+    If `changed_lines` is given (see git_changed_lines()) we only change the parts
+    of files which have changed.
+    If `profile` is true, a Profiler collects statistics per file and per selector;
+    `profile_stats` makes it collect cProfile stats too.
+    If `report` is true, a ChangeReporter records every rewrite made or skipped.
+    If `check` is true, the first change to each file raises ChangeFound.
+    If `count` is true, nothing is changed; a MatchCounter counts what the
+    selectors match instead, in a `sample` (a fraction) of the files if given.
+    If `timeout` is given, files which take longer than that many seconds are
+    given up on.
+    If `until_stable` is true, the selectors are applied to each file over and over
+    (up to `max_passes` times) until nothing changes.
+    If `engine` is 'auto' and there's only one script, which has a faster way
+    of doing its job than parsing each file (its transform_source() function),
+    that's used instead. 'verify' uses both, and checks they agree; 'cst' only
+    ever parses.
+    """
+    fixers = load_fixers(fixer_names)
+    if rules is not None:
+        # Scripts with none of the rules wouldn't do anything (but their
+        # prefilters would still let files through)
+        fixers = [fixer for fixer in fixers if set(rule_names(fixer)) & set(rules)]
+
+    # No way to pass this to .modify() callables, so we just set it at module level
+    for fixer in fixers:
+        fixer.flags.update(flags)
+
+    query = add_transforms(Query(), fixers)
+    if rules is not None:
+        query.transforms[:] = [
+            transform for transform in query.transforms if rule_name(transform) in rules
+        ]
+        for fixer in fixers:
+            for selector, parts in getattr(fixer, 'RULE_PARTS', {}).items():
+                if all(f'{selector}:{part}' in rules for part in parts):
+                    continue
+                for transform in query.transforms:
+                    if rule_name(transform) == selector:
+                        transform.filters.append(in_rule_parts(fixer, selector, rules))
+
+    if changed_lines is not None:
+
+        def in_changed_lines(node, capture, filename):
+            first, last = node_lines(node)
+            return any(
+                first <= changed_last and changed_first <= last
+                for changed_first, changed_last in changed_lines.get(filename, ())
+            )
+
+        for transform in query.transforms:
+            transform.filters.append(in_changed_lines)
+
+    reporter = None
+    if report:
+        reporter = ChangeReporter()
+        # Bowler's fixers call whatever is in these lists, so we can wrap them
+        for transform in query.transforms:
+            transform.callbacks[:] = [
+                reporter.wrap(callback) for callback in transform.callbacks
+            ]
+        for fixer in fixers:
+            if hasattr(fixer, 'skip_hook'):
+                fixer.skip_hook = reporter.skipped
+
+    if check:
+        for transform in query.transforms:
+            transform.callbacks[:] = [
+                stop_at_first_change(callback) for callback in transform.callbacks
+            ]
+
+    counter = None
+    if count:
+        counter = MatchCounter(sample, sample_seed)
+        for transform in query.transforms:
+            transform.callbacks[:] = [counter.callback(rule_name(transform))]
+
+    fast_path = None
+    # The fast paths don't know about the selectors, or what the modes below
+    # do to them.
+    if (
+        engine != 'cst'
+        and len(fixers) == 1
+        and hasattr(fixers[0], 'transform_source')
+        and changed_lines is None
+        and not report
+        and not profile
+        and not count
+    ):
+        fast_path = fixers[0].transform_source
+
+    pattern_cache = PatternCache()
+
+    def compile_pattern(fixer):
+        pattern_cache.compile_pattern(fixer)
+
+    fixer_classes = query.compile()
+    for transform, fixer_class in zip(query.transforms, fixer_classes):
+        # Bowler calls them all 'Fixer'. Name them after their callbacks instead,
+        # so we can tell them apart when reporting.
+        fixer_class.__name__ = rule_name(transform)
+        fixer_class.compile_pattern = compile_pattern
+
+    tool = DecrapifyTool(
+        fixer_classes,
+        worker_options={
+            'fixer_names': fixer_names,
+            'flags': flags,
+            'staged': staged,
+            'changed_lines': changed_lines,
+            'profile': profile,
+            'profile_stats': profile_stats,
+            'report': report,
+            'check': check,
+            'timeout': timeout,
+            'until_stable': until_stable,
+            'max_passes': max_passes,
+            'engine': engine,
+            'rules': rules,
+            'count': count,
+        },
+        staged=staged,
+        check=check,
+        counter=counter,
+        timeout=timeout,
+        until_stable=until_stable,
+        max_passes=max_passes,
+        fast_path=fast_path,
+        verify_fast_path=(engine == 'verify'),
+        profiler=Profiler(profile_stats) if profile else None,
+        reporter=reporter,
+        prefilter=combine_prefilters(fixers) if prefilter else None,
+        options={'print_function': True},
+        **kwargs,
+    )
+    # Creating the tool compiled the patterns
+    pattern_cache.save()
+    return tool
+
+
+class PatternCache:
+    """
+    Keeps compiled selector patterns in a file, so they don't need compiling
+    every time we start.
+    """
+
+    def __init__(self, path=None):
+        version = f'{fissix.__version__}-py{sys.version_info[0]}{sys.version_info[1]}'
+        self.path = path or os.path.join(CACHE_DIR, f'patterns-{version}.pickle')
+        try:
+            with open(self.path, 'rb') as f:
+                self.patterns = pickle.load(f)
+        except Exception:
+            # Missing, or from some incompatible version. We'll make a new one.
+            self.patterns = {}
+        self.changed = False
+
+    def compile_pattern(self, fixer):
+        """
+        Does the same as fissix's BaseFix.compile_pattern(), using the cache.
+        """
+        if fixer.PATTERN is None:
+            return
+        if fixer.PATTERN not in self.patterns:
+            self.patterns[fixer.PATTERN] = PatternCompiler().compile_pattern(
+                fixer.PATTERN, with_tree=True
+            )
+            self.changed = True
+        fixer.pattern, fixer.pattern_tree = self.patterns[fixer.PATTERN]
+
+    def save(self):
+        if not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(self.patterns, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.debug(f"Couldn't save compiled patterns to {self.path}: {e}")
+        self.changed = False
+
+
+# Every node type there is
+ALL_TYPES = frozenset(
+    chain(pygram.python_grammar.symbol2number.values(), pygram.python_grammar.tokens)
+)
+SYMBOL_TYPES = frozenset(pygram.python_grammar.symbol2number.values())
+
+
+def pattern_head_types(pattern):
+    """
+    Returns the types of node a pattern could match, or ALL_TYPES.
+
+    Like fissix's _get_head_types(), except that it knows `any< ... >` only matches
+    nodes with children, i.e. not leaves.
+    """
+    if isinstance(pattern, (pytree.NodePattern, pytree.LeafPattern)):
+        if pattern.type is not None:
+            return {pattern.type}
+        if isinstance(pattern, pytree.NodePattern) and any(
+            not (isinstance(part, pytree.WildcardPattern) and part.min == 0)
+            for part in pattern.content or ()
+        ):
+            return SYMBOL_TYPES
+        return ALL_TYPES
+    if isinstance(pattern, pytree.NegatedPattern):
+        if pattern.content:
+            return pattern_head_types(pattern.content)
+        return ALL_TYPES
+    if isinstance(pattern, pytree.WildcardPattern):
+        types = set()
+        for alternative in pattern.content:
+            for part in alternative:
+                types.update(pattern_head_types(part))
+        return types
+    return ALL_TYPES
+
+
+def fixers_by_head_type(fixers):
+    """
+    Returns a dict mapping node types to the fixers which could match them.
+    """
+    heads = defaultdict(list)
+    for fixer in fixers:
+        if fixer.pattern:
+            types = pattern_head_types(fixer.pattern)
+        elif fixer._accept_type is not None:
+            types = {fixer._accept_type}
+        else:
+            types = ALL_TYPES
+        for node_type in types:
+            heads[node_type].append(fixer)
+    return dict(heads)
+
+
+class NodeIndex:
+    """
+    Lists the nodes of a tree by type, so the selectors only need to look at nodes
+    they could match, rather than walking the whole tree.
+
+    Built as the file is parsed (see convert()), or else from an existing tree.
+    The parser builds trees from the bottom up, so either way the nodes are in
+    post-order, which is the order fissix would visit them in.
+    """
+
+    def __init__(self, tree=None):
+        self.nodes = []
+        # Maps each node type to the positions of those nodes in `nodes`
+        self.positions = defaultdict(list)
+        if tree is not None:
+            for node in tree.post_order():
+                self.add(node)
+
+    def add(self, node):
+        self.positions[node.type].append(len(self.nodes))
+        self.nodes.append(node)
+
+    def convert(self, grammar, raw_node):
+        """
+        A stand-in for pytree.convert(), for the parser, which indexes each new node.
+        """
+        node = pytree.convert(grammar, raw_node)
+        children = raw_node[3]
+        # Nodes with only one child are dropped in favour of the child
+        if not children or node is not children[0]:
+            self.add(node)
+        return node
+
+    @property
+    def root(self):
+        return self.nodes[-1] if self.nodes else None
+
+    def candidates(self, types):
+        """
+        Returns the nodes of the given types, in post-order.
+        """
+        positions = sorted(
+            chain.from_iterable(self.positions.get(t, ()) for t in types)
+        )
+        return [self.nodes[position] for position in positions]
+
+
+syms = pygram.python_symbols
+
+# Nodes whose children are statements, or the parts of a compound statement
+STATEMENT_CONTAINERS = frozenset(
+    {
+        syms.file_input,
+        syms.suite,
+        syms.if_stmt,
+        syms.while_stmt,
+        syms.for_stmt,
+        syms.try_stmt,
+        syms.with_stmt,
+        syms.funcdef,
+        syms.classdef,
+        syms.decorated,
+        syms.async_stmt,
+        syms.async_funcdef,
+    }
+)
+
+
+class SourceMap:
+    """
+    Remembers where each statement of a freshly parsed tree (and each part of each
+    compound statement) is in the source code, so that once the tree has been
+    changed, the changes can be found by following `was_changed` down from the
+    root, and diffed on their own. That way, the cost of diffing a file depends on
+    how much of it has changed, rather than how big it is.
+
+    Offsets are into the source, and lines are numbered from 0.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        # The offset of the start of each line (by '\n', as the tokenizer counts
+        # them), and of the end of the source
+        self.line_starts = [0]
+        newline = source.find('\n')
+        while newline >= 0:
+            self.line_starts.append(newline + 1)
+            newline = source.find('\n', newline + 1)
+        if self.line_starts[-1] != len(source):
+            self.line_starts.append(len(source))
+        self.tree = None
+        # Maps the id of each statement container to the container, its children,
+        # and where each of them started (and where the last one ended)
+        self.containers = {}
+
+    def map(self, tree):
+        """
+        Records where everything in `tree` (parsed from the source) is,
+        before it's changed.
+        """
+        self.tree = tree
+        stack = [(tree, len(self.source))]
+        while stack:
+            node, end = stack.pop()
+            children = tuple(node.children)
+            offsets = [self.offset_of(child) for child in children]
+            offsets.append(end)
+            self.containers[id(node)] = (node, children, offsets)
+            for child, child_end in zip(children, offsets[1:]):
+                if child.type in STATEMENT_CONTAINERS:
+                    stack.append((child, child_end))
+
+    def offset_of(self, node):
+        while node.children:
+            node = node.children[0]
+        return self.line_starts[node.lineno - 1] + node.column - len(node.prefix)
+
+    def line_of(self, offset):
+        return bisect_right(self.line_starts, offset) - 1
+
+    def lead_of(self, offset, code=''):
+        """
+        Returns what comes before `code`, at `offset`, on the same line.
+        """
+        line_start = self.line_starts[self.line_of(offset)]
+        return (self.source[line_start:offset] + code).rpartition('\n')[2]
+
+    def changes(self):
+        """
+        Returns a list of (start, end, text), in order, meaning source[start:end]
+        has been replaced by text; and a list of (statement, lead) for the
+        statements involved, and the indentation they're at.
+        """
+        changes = []
+        statements = {}
+        if self.tree.was_changed:
+            self.find_changes(self.tree, None, changes, statements)
+        return changes, list(statements.values())
+
+    def find_changes(self, node, compound, changes, statements):
+        """
+        Adds the changes in a container to `changes`, and the statements they're in
+        to `statements`. `compound` is the (statement, lead) `node` is part of,
+        unless node's children are statements.
+        """
+        _, children, offsets = self.containers[id(node)]
+        current = node.children
+        # The children which are still there, at either end
+        shortest = min(len(children), len(current))
+        head = 0
+        while head < shortest and current[head] is children[head]:
+            head += 1
+        tail = 0
+        while tail < shortest - head and current[-1 - tail] is children[-1 - tail]:
+            tail += 1
+
+        for index in range(head):
+            self.find_child_changes(
+                children[index],
+                offsets[index : index + 2],
+                compound,
+                changes,
+                statements,
+            )
+
+        removed_end = len(children) - tail
+        added = current[head : len(current) - tail]
+        if head < removed_end or added:
+            start = offsets[head]
+            changes.append((start, offsets[removed_end], ''.join(map(str, added))))
+            if compound is not None:
+                statements[id(compound[0])] = compound
+            else:
+                before = self.lead_of(start)
+                for statement in added:
+                    if statement.children:
+                        lead = (before + statement.prefix).rpartition('\n')[2]
+                        statements[id(statement)] = (statement, lead)
+                    before = (before + str(statement)).rpartition('\n')[2]
+
+        for index in range(removed_end, len(children)):
+            self.find_child_changes(
+                children[index],
+                offsets[index : index + 2],
+                compound,
+                changes,
+                statements,
+            )
+
+    def find_child_changes(self, child, span, compound, changes, statements):
+        if not child.was_changed:
+            return
+        if id(child) in self.containers:
+            if child.type == syms.suite:
+                compound = None
+            elif compound is None:
+                compound = (child, self.lead_of(span[0], child.prefix))
+            self.find_changes(child, compound, changes, statements)
+            return
+        start, end = span
+        changes.append((start, end, str(child)))
+        if compound is not None:
+            statements[id(compound[0])] = compound
+        elif child.children:
+            statements[id(child)] = (child, self.lead_of(start, child.prefix))
+
+    def outline(self, node):
+        """
+        Returns the code for a statement, with the bodies of any compound statements
+        in it (from the original tree) replaced by `pass`. Changes inside those
+        are checked on their own.
+        """
+        if id(node) not in self.containers:
+            return str(node)
+        if node.type == syms.suite:
+            # Along with the indentation of whatever comes after it
+            _, children, offsets = self.containers[id(node)]
+            return ' pass\n' + self.lead_of(offsets[-1])
+        return ''.join(self.outline(child) for child in node.children)
+
+    def diff(self, filename, changes, context=3):
+        """
+        Returns the hunks of a unified diff of the changes, like make_hunks() would
+        for the whole file.
+        """
+        source = self.source
+        line_starts = self.line_starts
+        num_lines = len(line_starts) - 1
+
+        # Group the changes by which lines they're on, with enough lines between
+        # the groups that their hunks can't touch
+        groups = []
+        for start, end, text in changes:
+            first = self.line_of(start)
+            last = bisect_left(line_starts, end)
+            if groups and first - groups[-1][1] <= 2 * context:
+                groups[-1][1] = max(last, groups[-1][1])
+                groups[-1][2].append((start, end, text))
+            else:
+                groups.append([first, last, [(start, end, text)]])
+
+        a, b = f'--- {filename}', f'+++ {filename}'
+        hunks = []
+        # How many more lines the new version has, before the current group
+        offset = 0
+        for first, last, group in groups:
+            first = max(first - context, 0)
+            last = min(last + context, num_lines)
+            old_lines = source[line_starts[first] : line_starts[last]].split('\n')
+            new_parts = []
+            position = line_starts[first]
+            for start, end, text in group:
+                new_parts.append(source[position:start])
+                new_parts.append(text)
+                position = end
+            new_parts.append(source[position : line_starts[last]])
+            new_lines = ''.join(new_parts).split('\n')
+            # Both end with a newline, which leaves an empty string at the end
+            del old_lines[-1], new_lines[-1]
+
+            matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+            for opcodes in matcher.get_grouped_opcodes(context):
+                i1, i2 = opcodes[0][1] + first, opcodes[-1][2] + first
+                j1, j2 = opcodes[0][3] + first + offset, opcodes[-1][4] + first + offset
+                hunk = [
+                    a,
+                    b,
+                    f'@@ -{unified_range(i1, i2)} +{unified_range(j1, j2)} @@',
+                ]
+                for tag, i1, i2, j1, j2 in opcodes:
+                    if tag == 'equal':
+                        hunk.extend(' ' + line for line in old_lines[i1:i2])
+                        continue
+                    hunk.extend('-' + line for line in old_lines[i1:i2])
+                    hunk.extend('+' + line for line in new_lines[j1:j2])
+                hunks.append(hunk)
+            offset += len(new_lines) - len(old_lines)
+        return hunks
+
+
+def unified_range(start, stop):
+    """
+    Formats a range of lines for a unified diff's hunk header, like difflib does.
+    """
+    length = stop - start
+    if length == 1:
+        return f'{start + 1}'
+    if not length:
+        # An empty range is given as the line before it
+        return f'{start},0'
+    return f'{start + 1},{length}'
+
+
+class ResultCache:
+    """
+    An sqlite file which remembers the files that needed no changes, so we can skip
+    them next time without even parsing them.
+
+    Entries are keyed by a hash of the file content, plus everything else that
+    could change the result: which scripts (and rules) are applied, their source
+    code, and their options. So it's safe for a team (or CI) to share one cache file.
+
+    Once there are more than `max_entries` entries, the least recently used are
+    thrown away at the end of each run.
+
+    Files which took longer than the --timeout are remembered too, along with the
+    timeout, so later runs with the same (or a shorter) --timeout don't waste time
+    on them again.
+
+    If `read_only` is true, nothing new is remembered.
+    """
+
+    CLEAN = 'clean'
+    TIMED_OUT = 'timed out'
+
+    def __init__(self, path, fixers, flags, max_entries, read_only=False, rules=None):
+        self.max_entries = max_entries
+        self.read_only = read_only
+        # Imported here to keep startup fast when there's no --cache
+        import sqlite3
+
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, '
+            'status TEXT NOT NULL, used REAL NOT NULL, timeout REAL)'
+        )
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(results)')]
+        if 'timeout' not in columns:
+            # Made before timeouts were remembered
+            self.db.execute('ALTER TABLE results ADD COLUMN timeout REAL')
+        self.used = []
+        self.pending = 0
+
+        version = hashlib.sha256()
+        version.update(json.dumps(
+            [
+                bowler.__version__,
+                fissix.__version__,
+                sorted(flags.items()),
+                rules and sorted(rules),
+            ]
+        ).encode())
+        for module_file in [__file__] + [fixer.__file__ for fixer in fixers]:
+            with open(module_file, 'rb') as f:
+                version.update(f.read())
+        self.version = version.digest()
+
+    def key(self, content):
+        """
+        Returns the cache key for a file with the given content (bytes).
+        """
+        return hashlib.sha256(self.version + content).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the status of an entry, and (if it timed out) the timeout it took
+        longer than; or (None, None) if there isn't one.
+        """
+        row = self.db.execute(
+            'SELECT status, timeout FROM results WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None, None
+        self.used.append((time.time(), key))
+        return row
+
+    def put(self, key, status, timeout=None):
+        if self.read_only:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO results (key, status, used, timeout) '
+            'VALUES (?, ?, ?, ?)',
+            (key, status, time.time(), timeout),
+        )
+        self.pending += 1
+        if self.pending >= 1000:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.db.executemany('UPDATE results SET used = ? WHERE key = ?', self.used)
+        (count,) = self.db.execute('SELECT COUNT(*) FROM results').fetchone()
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM results WHERE key IN '
+                '(SELECT key FROM results ORDER BY used LIMIT ?)',
+                (count - self.max_entries,),
+            )
+        self.db.commit()
+        self.db.close()
+
+
+class _LoadedStats:
+    """
+    Lets pstats.Stats load the stats from a cProfile.Profile in another process.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    Collects the statistics for --profile.
+
+    For each selector (named after its callbacks), counts the time spent on it,
+    the candidate nodes it was tried against, how many of them it matched and
+    how many times it actually modified something. For each file, the time taken,
+    the same counts and the peak memory used (traced by tracemalloc).
+
+    If `stats` is true, also runs cProfile, for more detail.
+    """
+
+    def __init__(self, stats=False):
+        # The profiling modules are imported as needed, to keep startup fast
+        import cProfile
+
+        self.selectors = defaultdict(Counter)
+        self.files = []
+        self.current_file = None
+        self.cprofile = cProfile.Profile() if stats else None
+        self.stats = None
+
+    def instrument(self, fixer):
+        """
+        Wraps a fixer's match() and transform(), to count what they do.
+        """
+        name = type(fixer).__name__
+        match = fixer.match
+        transform = fixer.transform
+
+        def profiled_match(node):
+            start = time.perf_counter()
+            try:
+                results = match(node)
+            finally:
+                self.count(name, 'seconds', time.perf_counter() - start)
+            self.count(name, 'candidates')
+            if results:
+                self.count(name, 'matches')
+            return results
+
+        def profiled_transform(node, results):
+            start = time.perf_counter()
+            before = str(node)
+            parent = node.parent
+            try:
+                new = transform(node, results)
+            finally:
+                self.count(name, 'seconds', time.perf_counter() - start)
+            if (
+                (new is not None and new is not node)
+                or node.parent is not parent
+                or str(node) != before
+            ):
+                self.count(name, 'modifications')
+            return new
+
+        fixer.match = profiled_match
+        fixer.transform = profiled_transform
+
+    def count(self, name, what, amount=1):
+        self.selectors[name][what] += amount
+        if self.current_file is not None:
+            self.current_file[name][what] += amount
+
+    def profile_file(self, filename, func, *args):
+        """
+        Calls `func(*args)`, recording how long it takes and how much memory it needs.
+        """
+        import tracemalloc
+
+        self.current_file = defaultdict(Counter)
+        tracemalloc.start()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.cprofile is not None:
+                self.cprofile.disable()
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            selectors = self.current_file
+            totals = sum(selectors.values(), Counter())
+            slowest = max(
+                selectors, key=lambda name: selectors[name]['seconds'], default=''
+            )
+            self.files.append(
+                {
+                    'filename': filename,
+                    'seconds': elapsed,
+                    'peak_memory': peak_memory,
+                    'candidates': totals['candidates'],
+                    'matches': totals['matches'],
+                    'modifications': totals['modifications'],
+                    'slowest_selector': slowest,
+                }
+            )
+            self.current_file = None
+
+    def pop(self):
+        """
+        Returns (and forgets) everything collected so far, in a picklable form.
+        """
+        data = {'selectors': dict(self.selectors), 'files': self.files}
+        if self.cprofile is not None:
+            self.cprofile.create_stats()
+            data['stats'] = self.cprofile.stats
+            self.cprofile = type(self.cprofile)()
+        self.selectors = defaultdict(Counter)
+        self.files = []
+        return data
+
+    def add(self, data):
+        """
+        Adds the data from another Profiler's pop(), e.g. from a worker process.
+        """
+        for name, counts in data['selectors'].items():
+            self.selectors[name].update(counts)
+        self.files.extend(data['files'])
+        if 'stats' in data:
+            self.add_stats(data['stats'])
+
+    def add_stats(self, stats):
+        if not stats:
+            # pstats refuses to load empty stats
+            return
+        if self.stats is None:
+            import pstats
+
+            self.stats = pstats.Stats(_LoadedStats(stats))
+        else:
+            self.stats.add(_LoadedStats(stats))
+
+    def report(self, top=20, file=sys.stderr):
+        print('\nSelectors:', file=file)
+        print(
+            f"{'':40}{'seconds':>10}{'candidates':>12}{'matches':>10}{'modified':>10}",
+            file=file,
+        )
+        for name, counts in sorted(
+            self.selectors.items(), key=lambda item: -item[1]['seconds']
+        ):
+            print(
+                f"{name[:40]:40}{counts['seconds']:10.3f}{counts['candidates']:12}"
+                f"{counts['matches']:10}{counts['modifications']:10}",
+                file=file,
+            )
+
+        print(f'\nSlowest {top} files:', file=file)
+        print(
+            f"{'':40}{'seconds':>10}{'peak MB':>10}{'matches':>10}{'modified':>10}"
+            "  slowest selector",
+            file=file,
+        )
+        for entry in sorted(self.files, key=lambda entry: -entry['seconds'])[:top]:
+            print(
+                f"{entry['filename'][-40:]:40}{entry['seconds']:10.3f}"
+                f"{entry['peak_memory'] / 2 ** 20:10.1f}{entry['matches']:10}"
+                f"{entry['modifications']:10}  {entry['slowest_selector']}",
+                file=file,
+            )
+
+    def dump_stats(self, filename):
+        """
+        Writes the cProfile stats from all processes to a file, for use with pstats.
+        """
+        # Whatever was profiled in this process
+        self.cprofile.create_stats()
+        self.add_stats(self.cprofile.stats)
+        if self.stats is not None:
+            self.stats.dump_stats(filename)
+
+
+class ChangeFound(Exception):
+    """
+    Raised (in --check mode) as soon as a script changes something,
+    to stop processing the file.
+    """
+
+    def __init__(self, filename, line, fixer, callback):
+        super().__init__(filename, line, fixer, callback)
+        self.filename = filename
+        self.line = line
+        self.fixer = fixer
+        self.callback = callback
+
+    def __str__(self):
+        return (
+            f'{self.filename}:{self.line}: '
+            f'would be changed by {self.fixer} ({self.callback})'
+        )
+
+
+class FileTimedOut(BaseException):
+    """
+    Raised when a file has taken longer than the --timeout to process.
+
+    It's not an Exception, so that nothing on the way (e.g. fissix's handling of
+    parse errors) mistakes it for a problem with the file and carries on.
+    """
+
+    def __init__(self, filename, seconds):
+        super().__init__(filename, seconds)
+        self.filename = filename
+        self.seconds = seconds
+
+    def __str__(self):
+        return f'{self.filename}: timed out after {self.seconds:g}s'
+
+
+@contextmanager
+def time_limit(filename, seconds):
+    """
+    Raises FileTimedOut if the body of the `with` block takes more than `seconds`.
+
+    Uses SIGALRM, so it only works in the main thread, and not on Windows.
+    """
+
+    def timed_out(signum, frame):
+        raise FileTimedOut(filename, seconds)
+
+    previous_handler = signal.signal(signal.SIGALRM, timed_out)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def stop_at_first_change(callback):
+    """
+    Wraps a .modify() callback so it raises ChangeFound if it changes anything.
+    """
+
+    @wraps(callback)
+    def checked_callback(node, capture, filename):
+        line = node_lines(node)[0]
+        before = str(node)
+        place = place_of(node)
+        new = callback(node, capture, filename)
+        if str(replacement_of(node, new, place)) != before:
+            raise ChangeFound(filename, line, callback.__module__, callback.__name__)
+        return new
+
+    return checked_callback
+
+
+def marks_changes(transform):
+    """
+    Wraps a fixer's transform() so the node it's given (and its parent, in case
+    it's been replaced) is marked as changed, whatever it does.
+
+    Not every way of changing a tree sets `was_changed` (assigning to a leaf's
+    value doesn't, for one), and SourceMap relies on it to find the changes.
+
+    Callbacks which change their node in place may return it, but fissix would
+    then replace the node with itself, which leaves it thinking it has no parent
+    (and breaks the next pass with --until-stable). That's the same as
+    returning None.
+    """
+
+    @wraps(transform)
+    def marking_transform(node, results):
+        parent = node.parent
+        try:
+            new = transform(node, results)
+            return None if new is node else new
+        finally:
+            node.changed()
+            if parent is not None:
+                parent.changed()
+
+    return marking_transform
+
+
+def place_of(node):
+    """
+    Returns a node's parent and its index among the parent's children,
+    so we can tell later what's been put in its place (see replacement_of()).
+    """
+    parent = node.parent
+    if parent is None:
+        return None, None
+    # Not children.index(), which compares nodes by value
+    for index, child in enumerate(parent.children):
+        if child is node:
+            return parent, index
+
+
+def replacement_of(node, new, place):
+    """
+    Returns what a .modify() callback has replaced a node with: either what it
+    returned (`new`), or whatever it put in the node's place (from place_of(),
+    before the callback) in the tree itself.
+    """
+    parent, index = place
+    if new is not None:
+        return new
+    if parent is not None and node.parent is None and index < len(parent.children):
+        return parent.children[index]
+    return node
+
+
+def source_of(node):
+    """
+    Returns the code for a node, without the whitespace and comments before it.
+    """
+    return str(node)[len(node.prefix) :]
+
+
+class ChangeReporter:
+    """
+    Collects the data for --report-jsonl: a record of each rewrite which the
+    scripts' callbacks make, or decline to make.
+    """
+
+    def __init__(self):
+        # Maps filenames to lists of records
+        self.records = defaultdict(list)
+        self.skip_reason = None
+        # With --until-stable, which pass over the file we're on
+        self.current_pass = None
+
+    def wrap(self, callback):
+        """
+        Wraps a .modify() callback, to record what it does.
+        """
+
+        @wraps(callback)
+        def reported_callback(node, capture, filename):
+            first_line, last_line = node_lines(node)
+            before = source_of(node)
+            place = place_of(node)
+            self.skip_reason = None
+            new = callback(node, capture, filename)
+            after = source_of(replacement_of(node, new, place))
+
+            record = {
+                'file': filename,
+                'first_line': first_line,
+                'last_line': last_line,
+                'fixer': callback.__module__,
+                'callback': callback.__name__,
+                'before': before,
+            }
+            if self.current_pass is not None:
+                record['pass'] = self.current_pass
+            if after == before:
+                record.update(status='skipped', reason=self.skip_reason)
+            else:
+                record.update(status='applied', after=after)
+            self.records[filename].append(record)
+            return new
+
+        return reported_callback
+
+    def skipped(self, node, reason):
+        """
+        Used as the scripts' `skip_hook`, to find out why they skipped something.
+        """
+        self.skip_reason = reason
+
+    def passes(self, filename, count, stable):
+        """
+        Records how many passes (with --until-stable) a file took.
+        """
+        self.records[filename].append(
+            {
+                'file': filename,
+                'status': 'stable' if stable else 'still changing',
+                'passes': count,
+            }
+        )
+
+    def pop(self):
+        """
+        Returns (and forgets) all the records collected so far.
+        """
+        records = dict(self.records)
+        self.records.clear()
+        return records
+
+    def add(self, records):
+        """
+        Adds the records from another ChangeReporter's pop(), e.g. from a worker process.
+        """
+        for filename, file_records in records.items():
+            self.records[filename].extend(file_records)
+
+    def write(self, f, filename, exc=None):
+        """
+        Writes the records for a finished file as JSON lines, and forgets them.
+
+        If the file couldn't be changed because of an exception, that's recorded
+        instead of the rewrites (none of which were applied).
+        """
+        records = self.records.pop(filename, [])
+        if isinstance(exc, FileTimedOut):
+            records = [{'file': filename, 'status': 'timed out', 'reason': str(exc)}]
+        elif exc is not None:
+            records = [
+                {
+                    'file': filename,
+                    'status': 'failed',
+                    'reason': f'{type(exc).__name__}: {exc}',
+                }
+            ]
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+        f.flush()
+
+
+def directory_of(filename):
+    return os.path.dirname(filename) or os.curdir
+
+
+def in_sample(filename, fraction, seed):
+    """
+    Whether a file is in a random sample of the given fraction of files.
+
+    Decided by a hash of its path, so the same files are chosen whatever order
+    they're found in.
+    """
+    digest = hashlib.sha256(f'{seed}:{os.path.normpath(filename)}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') < fraction * 2**64
+
+
+def in_shard(filename, index, count):
+    """
+    Whether a file is in the `index`th (counting from 1) of `count` shards.
+
+    Decided by a hash of its path relative to the current directory, so every
+    machine puts each file in the same shard, however the files are found.
+    """
+    path = os.path.relpath(filename).replace(os.sep, '/')
+    digest = hashlib.sha256(path.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index - 1
+
+
+def extrapolate(total, squares, sampled, population):
+    """
+    Estimates the total of something over `population` files, given its total
+    (and the total of its squares) over a random sample of `sampled` of them.
+
+    Returns the estimate and the margin of error of its 95% confidence interval,
+    either of which is None if there's no telling.
+    """
+    if sampled >= population:
+        return total, 0
+    if not sampled:
+        return None, None
+    mean = total / sampled
+    if sampled == 1:
+        return mean * population, None
+    variance = (squares - total * mean) / (sampled - 1)
+    # With the finite population correction
+    error = 1.96 * population * math.sqrt(
+        variance / sampled * (1 - sampled / population)
+    )
+    return mean * population, error
+
+
+def format_estimate(estimate, error):
+    if estimate is None:
+        return '?'
+    if error is None:
+        return f'{estimate:.0f} ± ?'
+    return f'{estimate:.0f} ± {error:.0f}'
+
+
+class MatchCounter:
+    """
+    Counts what each selector matches, for --count, instead of changing anything.
+
+    The selectors' callbacks are replaced by callback(), which counts the matches
+    in the current file; pop() returns those. add() adds them to the totals, per
+    selector and per directory.
+
+    If `sample` (a fraction) is given, only that proportion of the files found
+    are looked at (see sample()), and report() extrapolates to all of them.
+    """
+
+    def __init__(self, sample=None, seed=0):
+        self.sample_fraction = sample
+        self.seed = seed
+        self.names = []
+        self.current = Counter()
+        # Maps each directory to the number of files found in it, and looked at
+        self.found = Counter()
+        self.looked_at = Counter()
+        # Keyed by ('selector', name) or ('directory', path): the number of
+        # matches, the sum of the squares of the number in each file, and the
+        # number of files with any
+        self.matches = Counter()
+        self.squares = Counter()
+        self.files = Counter()
+
+    def callback(self, name):
+        """
+        Returns a .modify() callback which counts a match for the named selector.
+        """
+        self.names.append(name)
+
+        def count_match(node, capture, filename):
+            self.current[name] += 1
+
+        count_match.__name__ = name
+        return count_match
+
+    def pop(self):
+        """
+        Returns (and forgets) the counts for the current file.
+        """
+        current, self.current = self.current, Counter()
+        return current
+
+    def sample(self, filenames):
+        """
+        Yields the files to look at, of those found.
+        """
+        for filename in filenames:
+            directory = directory_of(filename)
+            self.found[directory] += 1
+            if self.sample_fraction is None or in_sample(
+                filename, self.sample_fraction, self.seed
+            ):
+                self.looked_at[directory] += 1
+                yield filename
+
+    def drop(self, filename):
+        """
+        Leaves a file out of the sample, since we couldn't count what's in it.
+        """
+        self.looked_at[directory_of(filename)] -= 1
+
+    def add(self, filename, counts):
+        """
+        Adds a file's counts (from pop()) to the totals.
+        """
+        keys = [(('selector', name), count) for name, count in counts.items()]
+        keys.append((('directory', directory_of(filename)), sum(counts.values())))
+        for key, count in keys:
+            if count:
+                self.matches[key] += count
+                self.squares[key] += count * count
+                self.files[key] += 1
+
+    def report(self, file=sys.stdout):
+        population = sum(self.found.values())
+        sampled = sum(self.looked_at.values())
+        if self.sample_fraction is not None:
+            print(
+                f"Looked at {sampled} of {population} files "
+                f"(a {self.sample_fraction * 100:g}% sample, seed {self.seed}). "
+                "The totals are estimates, ± a 95% confidence interval.",
+                file=file,
+            )
+            print(file=file)
+
+        def column(total, squares, sampled, population):
+            if self.sample_fraction is None:
+                return str(total)
+            return format_estimate(*extrapolate(total, squares, sampled, population))
+
+        def row(title, key, sampled, population):
+            matches = column(self.matches[key], self.squares[key], sampled, population)
+            # Whether each file has any is a count of 0 or 1, which squares to itself
+            files = column(self.files[key], self.files[key], sampled, population)
+            print(f'{title:<50} {matches:>15} {files:>15}', file=file)
+
+        print(f"{'selector':<50} {'matches':>15} {'files':>15}", file=file)
+        for name in self.names:
+            row(name, ('selector', name), sampled, population)
+        print(file=file)
+        print(f"{'directory':<50} {'matches':>15} {'files':>15}", file=file)
+        for directory in sorted(self.found):
+            if self.matches['directory', directory]:
+                row(
+                    directory,
+                    ('directory', directory),
+                    self.looked_at[directory],
+                    self.found[directory],
+                )
+
+
+# Files smaller than this get sent to worker processes in batches,
+# so we don't pay inter-process overhead for every tiny file.
+BATCH_BYTES = 256 * 1024
+
+# Files are sent to the worker processes largest first, from this many at a time.
+# Looking further ahead would hold up the first results (and the output), and
+# use more memory for results waiting on the files before them.
+LOOKAHEAD_FILES = 500
+
+# Used by worker processes; see _init_worker()
+_worker_tool = None
+# How many files this worker process has done
+_worker_files = 0
+
+
+def _init_worker(options):
+    global _worker_tool
+    # Bowler's fixer classes are closures, so can't be pickled. Build our own.
+    _worker_tool = build_tool(**options, interactive=False, write=False)
+
+
+def _refactor_batch(filenames):
+    """
+    Refactors some files in a worker process.
+
+    Returns the results, and whatever the tool measured or recorded along the way
+    (including how many files the worker has done, and how big it's got).
+    """
+    global _worker_files
+    _worker_tool.timings.clear()
+    _worker_tool.stats.clear()
+    results = [(filename, *_worker_tool.refactor_one(filename)) for filename in filenames]
+    _worker_files += len(filenames)
+    extras = {
+        'timings': _worker_tool.timings,
+        'stats': _worker_tool.stats,
+        'worker': {'files': _worker_files, 'rss': current_rss()},
+    }
+    if _worker_tool.profiler is not None:
+        extras['profile'] = _worker_tool.profiler.pop()
+    if _worker_tool.reporter is not None:
+        extras['report'] = _worker_tool.reporter.pop()
+    return results, extras
+
+
+def make_batches(filenames, max_files=None, lookahead=LOOKAHEAD_FILES):
+    """
+    Groups files into batches for the worker processes, as they come.
+
+    The files are taken `lookahead` at a time, and each lot is batched largest
+    first, so a big file doesn't hold up the end of the run by being started last.
+    (Unless it's in the last lot, and the rest of that is tiny: sorting all the
+    files would mean finding them all before starting on any.)
+    Large files get a batch to themselves; small ones are grouped together
+    until the batch reaches BATCH_BYTES (or has `max_files` files).
+    """
+    filenames = iter(filenames)
+    while True:
+        window = list(islice(filenames, lookahead))
+        if not window:
+            return
+        sizes = {}
+        for filename in window:
+            try:
+                sizes[filename] = os.path.getsize(filename)
+            except OSError:
+                # Will be reported when the worker tries to read it.
+                sizes[filename] = 0
+
+        batch = []
+        batch_size = 0
+        for filename in sorted(window, key=lambda filename: -sizes[filename]):
+            batch.append(filename)
+            batch_size += sizes[filename]
+            if batch_size >= BATCH_BYTES or len(batch) == max_files:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+
+
+class DecrapifyTool(BowlerTool):
+    """
+    A BowlerTool which can spread the work over several processes,
+    while still reporting and writing files in a predictable order.
+
+    Files are processed as they're found, rather than collecting them all first.
+
+    Keeps track of how much time is spent in each phase (see PHASES) in `timings`.
+    """
+
+    PHASES = ('read', 'parse', 'match', 'modify', 'diff', 'write')
+
+    def __init__(
+        self,
+        fixers,
+        *args,
+        worker_options=None,
+        jobs=1,
+        max_files_per_worker=None,
+        max_worker_memory=None,
+        staged=False,
+        check=False,
+        fail_fast=False,
+        counter=None,
+        cache=None,
+        prefilter=None,
+        show_timings=False,
+        profiler=None,
+        profile_stats_file=None,
+        reporter=None,
+        report_out=None,
+        exclude=(),
+        gitignore=True,
+        patch_out=None,
+        output_dir=None,
+        fsync=False,
+        timeout=None,
+        until_stable=False,
+        max_passes=10,
+        fast_path=None,
+        verify_fast_path=False,
+        shard=None,
+        **kwargs,
+    ):
+        # Set before calling super(), which calls get_fixers()
+        self.timings = Counter()
+        self.profiler = profiler
+        self.reporter = reporter
+        super().__init__(fixers, *args, **kwargs)
+        # Narrower than fissix's own, so fewer nodes need looking at
+        self.bmi_pre_order_heads = fixers_by_head_type(self.bmi_pre_order)
+        self.bmi_post_order_heads = fixers_by_head_type(self.bmi_post_order)
+        # The nodes of the tree being refactored; see refactor_string()
+        self.node_index = None
+        # Where everything in the tree being refactored was in its source;
+        # see refactor_file()
+        self.source_map = None
+        # The arguments to build_tool() for an equivalent tool in a worker process
+        self.worker_options = worker_options
+        self.jobs = jobs
+        # Worker processes are replaced once they've done this many files,
+        # or got this big (in bytes)
+        self.max_files_per_worker = max_files_per_worker
+        self.max_worker_memory = max_worker_memory
+        self.staged = staged
+        self.check = check
+        self.fail_fast = fail_fast
+        # With --count, counts what the selectors match instead of changing anything
+        self.counter = counter
+        # With --shard, the (index, count) of the shard of the files to process
+        self.shard = shard
+        self.cache = cache
+        self.prefilter = prefilter
+        self.show_timings = show_timings
+        self.profile_stats_file = profile_stats_file
+        self.exclude = exclude
+        self.gitignore = gitignore
+        # If given, a file to write accepted changes to, instead of the source files
+        self.patch_out = patch_out
+        # If given, the changed files are written to the same (relative) paths
+        # in this directory, rather than over the source files
+        self.output_dir = output_dir
+        # Whether to make sure the files written have reached the disk, at the end
+        self.fsync = fsync
+        self.written = []
+        # If given, a file to write the reporter's records to
+        self.report_out = report_out
+        # If given, how many seconds to spend on each file before giving up on it
+        self.timeout = timeout
+        # Whether to keep applying the selectors to each file until nothing changes
+        # (up to max_passes times)
+        self.until_stable = until_stable
+        self.max_passes = max_passes
+        # If given, a function which does the same as the fixers, to a file's source
+        # code, without parsing it (or returns None if it can't)
+        self.fast_path = fast_path
+        self.verify_fast_path = verify_fast_path
+        self.stats = Counter()
+        # Cache keys for the files we're working on; see triage()
+        self.cache_keys = {}
+
+    def timed(self, phase, func):
+        """
+        Wraps a function so the time spent in it is added to `timings[phase]`.
+        """
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.timings[phase] += time.perf_counter() - start
+
+        return wrapper
+
+    def get_fixers(self):
+        pre, post = super().get_fixers()
+        for fixer in pre + post:
+            fixer.transform = self.timed('modify', marks_changes(fixer.transform))
+            if self.profiler is not None:
+                self.profiler.instrument(fixer)
+        return pre, post
+
+    def refactor_string(self, data, name):
+        # Index the nodes as they're parsed, for traverse_by()
+        self.node_index = NodeIndex()
+        self.driver.convert = self.node_index.convert
+        try:
+            return super().refactor_string(data, name)
+        finally:
+            self.driver.convert = pytree.convert
+            self.node_index = None
+
+    def refactor_tree(self, tree, name):
+        if self.source_map is not None and self.source_map.tree is None:
+            self.source_map.map(tree)
+        if not self.until_stable:
+            return self.refactor_tree_once(tree, name)
+
+        # Keep applying the selectors to the changed tree, in case
+        # one change has made another possible
+        before = str(tree)
+        for passes in range(1, self.max_passes + 1):
+            if self.reporter is not None:
+                self.reporter.current_pass = passes
+            self.refactor_tree_once(tree, name)
+            after = str(tree)
+            if after == before:
+                stable = True
+                self.stats[f"stable after {passes} pass{'es' if passes > 1 else ''}"] += 1
+                break
+            before = after
+            # The index is out of date now
+            self.node_index = None
+        else:
+            stable = False
+            log.warning(f"{name}: still changing after {passes} passes; giving up")
+            self.stats[f'still changing after {passes} passes'] += 1
+        if self.reporter is not None:
+            self.reporter.passes(name, passes, stable)
+            self.reporter.current_pass = None
+        return tree.was_changed
+
+    def refactor_tree_once(self, tree, name):
+        if self.node_index is None or self.node_index.root is not tree:
+            # Not parsed by refactor_string(), or changed since
+            self.node_index = NodeIndex(tree)
+        # Everything but the modifications themselves is matching
+        start = time.perf_counter()
+        modify_before = self.timings['modify']
+        try:
+            return super().refactor_tree(tree, name)
+        finally:
+            self.timings['match'] += (
+                time.perf_counter() - start - (self.timings['modify'] - modify_before)
+            )
+
+    def traverse_by(self, fixers, traversal):
+        # Rather than walking the whole tree (in post-order) trying every node,
+        # only visit the nodes (in the same order) which the fixers could match.
+        # The modifiers only change the node they're given (and what's inside it),
+        # which has already been visited, so the rest of the nodes are the same
+        # either way.
+        if fixers is self.bmi_post_order_heads and fixers:
+            types = [node_type for node_type in fixers if fixers[node_type]]
+            traversal = self.node_index.candidates(types)
+        super().traverse_by(fixers, traversal)
+
+    def is_excluded(self, path, top):
+        """
+        Whether a path matches one of the --exclude globs, either by its name
+        or by its path relative to the directory given on the command line.
+        """
+        name = os.path.basename(path)
+        relative = os.path.relpath(path, top)
+        return any(
+            fnmatch.fnmatch(name, glob) or fnmatch.fnmatch(relative, glob)
+            for glob in self.exclude
+        )
+
+    def walk(self, directory, top, rules):
+        """
+        Yields the python files in a directory, lazily and in sorted order.
+
+        Files and directories starting with '.', or ignored by .gitignore (given the
+        rules from the parent directories), or matching an --exclude glob are skipped.
+        """
+        if self.gitignore:
+            rules = rules + read_gitignore(os.path.abspath(directory))
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            log.error(f"Skipping {directory}: {e}")
+            return
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            is_dir = entry.is_dir()
+            if is_dir and self.is_output_dir(entry.path):
+                # That's what we've written
+                continue
+            if self.is_excluded(entry.path, top) or is_ignored(
+                entry.path, is_dir, rules
+            ):
+                continue
+            if is_dir:
+                yield from self.walk(entry.path, top, rules)
+            elif self.filename_matcher(entry.path):
+                yield entry.path
+
+    def is_output_dir(self, path):
+        if self.output_dir is None:
+            return False
+        return os.path.abspath(path) == os.path.abspath(self.output_dir)
+
+    def iter_filenames(self, items):
+        """
+        Yields the python files to process, given some files and directories.
+
+        Files given explicitly are always processed, unless they match an --exclude.
+        """
+        seen = set()
+        for dir_or_file in items:
+            if os.path.isdir(dir_or_file):
+                rules = inherited_gitignore_rules(dir_or_file) if self.gitignore else []
+                filenames = self.walk(dir_or_file, dir_or_file, rules)
+            elif self.is_excluded(dir_or_file, os.curdir):
+                continue
+            else:
+                filenames = [dir_or_file]
+
+            for filename in filenames:
+                if filename not in seen:
+                    seen.add(filename)
+                    yield filename
+
+    def read_bytes(self, filename):
+        """
+        Reads a file; or its staged content, if we're working on the index.
+        """
+        if self.staged:
+            return git('show', f':./{os.path.relpath(filename)}')
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def _read_python_source(self, filename):
+        if not self.staged:
+            return super()._read_python_source(filename)
+        try:
+            content = self.read_bytes(filename)
+        except subprocess.CalledProcessError as e:
+            raise OSError(f"couldn't read staged content: {e}") from e
+        encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+        return content.decode(encoding), encoding
+
+    def apply_hunks(self, accepted_hunks, filename):
+        if self.patch_out is not None:
+            if accepted_hunks:
+                patch = format_patch(filename, accepted_hunks, self.read_bytes(filename))
+                self.timed('write', self.patch_out.write)(patch)
+                self.stats['files in patch'] += 1
+            return
+        if accepted_hunks and self.staged and self.output_dir is None:
+            with open(filename, 'rb') as f:
+                on_disk = f.read()
+            if on_disk != self.read_bytes(filename):
+                log.error(
+                    f"Not writing {filename}: it has unstaged changes, "
+                    "and the diff is for the staged content"
+                )
+                return
+        if accepted_hunks:
+            self.timed('write', self.write_file)(accepted_hunks, filename)
+
+    def write_file(self, hunks, filename):
+        """
+        Applies hunks to a file, and replaces it (or its copy in output_dir) with the
+        result in one go, rather than changing it in place.
+        """
+        path = filename
+        if self.output_dir is not None:
+            relative = os.path.relpath(filename)
+            if relative.split(os.sep)[0] == os.pardir:
+                log.error(
+                    f"Not writing {filename}: it's outside the current directory, "
+                    f"so it has no place in {self.output_dir}"
+                )
+                return
+            path = os.path.join(self.output_dir, relative)
+        content = self.read_bytes(filename)
+        encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+        try:
+            new_content = patch_text(content.decode(encoding), hunks).encode(encoding)
+        except (ValueError, UnicodeError) as e:
+            log.error(f"Not writing {filename}: {e}")
+            return
+        try:
+            if path != filename:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomically(path, new_content, stat.S_IMODE(os.stat(filename).st_mode))
+        except OSError as e:
+            log.error(f"Couldn't write {path}: {e}")
+            return
+        self.stats['files written'] += 1
+        if self.fsync:
+            self.written.append(path)
+
+    def refactor_file(self, filename, *a, **k):
+        """
+        Like BowlerTool.refactor_file(), but returns None if the file
+        couldn't be read or parsed.
+
+        In --check mode, returns a list of the changes found (at most one)
+        instead of the hunks; and in --count mode, the counts from the MatchCounter.
+        """
+        try:
+            input, encoding = self.timed('read', self._read_python_source)(filename)
+        except (OSError, UnicodeDecodeError) as e:
+            log.error(f"Skipping {filename}: failed to read because {e}")
+            return None
+        if input is None:
+            return None
+
+        if not input.endswith("\n"):
+            input += "\n"
+        if self.fast_path is not None:
+            new_text = self.timed('parse', self.fast_path)(input)
+            if new_text is not None:
+                return self.fast_path_result(filename, input, new_text)
+            # Couldn't tokenize it. Let the parser say why.
+        start = time.perf_counter()
+        tree_before = self.timings['match'] + self.timings['modify']
+        if self.counter is not None:
+            # Forget anything left over from a file which failed part way through
+            self.counter.pop()
+        # refactor_tree() maps the tree before changing it
+        diffing = not self.check and self.counter is None
+        self.source_map = SourceMap(input) if diffing else None
+        try:
+            tree = self.refactor_string(input, filename)
+        except ChangeFound as change:
+            forget_traceback(change)
+            return [change]
+        finally:
+            source_map, self.source_map = self.source_map, None
+            self.timings['parse'] += (
+                time.perf_counter()
+                - start
+                - (self.timings['match'] + self.timings['modify'] - tree_before)
+            )
+        if tree is None:
+            # refactor_string() already logged why
+            return None
+        try:
+            if self.check:
+                return []
+            if self.counter is not None:
+                return self.counter.pop()
+            return self.timed('diff', self.diff_changes)(filename, source_map)
+        finally:
+            release_tree(tree)
+
+    def diff_changes(self, filename, source_map):
+        """
+        Diffs the changes to a file's tree into hunks, like processed_file(), but
+        only renders, diffs and re-parses (to check they're valid) the statements
+        which have changed.
+        """
+        changes, statements = source_map.changes()
+        hunks = source_map.diff(filename, changes)
+        if not hunks:
+            return hunks
+        for statement, lead in statements:
+            code = source_map.outline(statement)[len(statement.prefix) :]
+            # Not the indentation of whatever comes after it
+            code = code[: code.rfind('\n') + 1]
+            # Only spaces and tabs indent; the tokenizer starts counting again
+            # after a form feed
+            indent = ''.join(
+                char for char in lead.rpartition('\f')[2] if char in ' \t'
+            )
+            if indent:
+                # It's indented, so it has to be in a block
+                code = f'if True:\n{indent}{code}'
+            try:
+                release_tree(self.driver.parse_string(code))
+            except Exception as e:
+                raise BadTransform(
+                    f"Transforms generated invalid CST for {filename}",
+                    filename=filename,
+                    hunks=hunks,
+                ) from e
+        return hunks
+
+    def fast_path_result(self, filename, input, new_text):
+        """
+        Returns what refactor_file() should, given the new text of a file from the
+        fast path. If we're verifying the fast path, the tree is used too, and if
+        the results differ that's a BadTransform.
+        """
+        if self.verify_fast_path:
+            tree = self.refactor_string(input, filename)
+            if tree is None:
+                return None
+            expected = str(tree)
+            release_tree(tree)
+            if new_text != expected:
+                raise BadTransform(
+                    f"The fast path and the tree disagree about {filename}",
+                    filename=filename,
+                    hunks=self.make_hunks(filename, expected, new_text),
+                )
+        if self.check:
+            for line, (old, new) in enumerate(
+                zip(input.splitlines(), new_text.splitlines()), 1
+            ):
+                if old != new:
+                    fixer = self.fast_path.__module__
+                    return [ChangeFound(filename, line, fixer, self.fast_path.__name__)]
+            return []
+        return self.timed('diff', self.make_hunks)(filename, input, new_text)
+
+    def make_hunks(self, filename, old_text, new_text):
+        """
+        Diffs two versions of a file into hunks, like processed_file(), but
+        without re-parsing the new version.
+        """
+        hunks = []
+        if old_text != new_text:
+            a, b, *lines = difflib.unified_diff(
+                split_lines(old_text),
+                split_lines(new_text),
+                filename,
+                filename,
+                lineterm='',
+            )
+            for line in lines:
+                if line.startswith('@@'):
+                    hunks.append([a, b])
+                hunks[-1].append(line)
+        return hunks
+
+    def refactor_file_or_profile(self, filename):
+        if self.profiler is not None:
+            return self.profiler.profile_file(filename, self.refactor_file, filename)
+        return self.refactor_file(filename)
+
+    def refactor_one(self, filename):
+        """
+        Refactors a single file, returning a (hunks, exception) pair.
+
+        hunks is None if the file couldn't be read or parsed, or took too long.
+        """
+        try:
+            if self.timeout:
+                with time_limit(filename, self.timeout):
+                    hunks = self.refactor_file_or_profile(filename)
+            else:
+                hunks = self.refactor_file_or_profile(filename)
+            return hunks, None
+        except FileTimedOut as e:
+            forget_traceback(e)
+            return None, e
+        except BowlerException as e:
+            log.exception(f"Bowler exception during transform of {filename}: {e}")
+            forget_traceback(e)
+            return e.hunks, e
+        except Exception as e:
+            log.exception(f"Skipping {filename}: failed to transform because {e}")
+            forget_traceback(e)
+            return [], e
+
+    def refactor_parallel(self, filenames):
+        """
+        Refactors files in a pool of worker processes.
+
+        Yields (filename, hunks, exception) in the same order as `filenames`,
+        as soon as each file and all the files before it are done (though they're
+        sent to the workers in a different order; see make_batches()).
+        Only a few batches per worker are queued up at a time, so `filenames`
+        can be a generator which is still finding files.
+
+        Once a worker has done max_files_per_worker files or grown past
+        max_worker_memory, the pool is retired (after finishing the batches it's
+        already been given) and a fresh one takes over.
+        """
+        # Imported here; it's slow to import and only needed with --jobs
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        def start_pool():
+            return ProcessPoolExecutor(
+                self.jobs,
+                initializer=_init_worker,
+                initargs=(self.worker_options,),
+            )
+
+        pool = start_pool()
+        retired_pools = []
+        # Maps the future for each unfinished batch to the pool it's in
+        pending = {}
+        # The files in the order they were found, and the results for the ones
+        # which are done, by filename
+        order = deque()
+        done = {}
+
+        def found(filenames):
+            for filename in filenames:
+                order.append(filename)
+                yield filename
+
+        def finished():
+            while order and order[0] in done:
+                yield done.pop(order.popleft())
+
+        def finish_batches():
+            # Whichever finish first, so a big file doesn't hold up the rest
+            for future in wait(pending, return_when=FIRST_COMPLETED).done:
+                finish_batch(future)
+
+        def finish_batch(future):
+            nonlocal pool
+            batch_pool = pending.pop(future)
+            results, extras = future.result()
+            for result in results:
+                done[result[0]] = result
+            self.timings.update(extras['timings'])
+            self.stats.update(extras['stats'])
+            if 'profile' in extras:
+                self.profiler.add(extras['profile'])
+            if 'report' in extras:
+                self.reporter.add(extras['report'])
+            if batch_pool is pool and self.worker_worn_out(extras['worker']):
+                pool.shutdown(wait=False)
+                retired_pools.append(pool)
+                pool = start_pool()
+                self.stats['worker pools recycled'] += 1
+
+        try:
+            for batch in make_batches(found(filenames), self.max_files_per_worker):
+                pending[pool.submit(_refactor_batch, batch)] = pool
+                # Keep the workers busy, without queueing up too many batches, or
+                # too many results waiting on the files before them
+                while pending and (
+                    len(pending) >= 2 * self.jobs or len(order) > 2 * LOOKAHEAD_FILES
+                ):
+                    finish_batches()
+                    yield from finished()
+            while pending:
+                finish_batches()
+                yield from finished()
+        finally:
+            for future in pending:
+                future.cancel()
+            for old_pool in retired_pools:
+                old_pool.shutdown()
+            pool.shutdown()
+
+    def worker_worn_out(self, worker):
+        """
+        Whether a worker (as described by _refactor_batch()) should be replaced.
+        """
+        if self.max_files_per_worker and worker['files'] >= self.max_files_per_worker:
+            return True
+        return bool(self.max_worker_memory and worker['rss'] >= self.max_worker_memory)
+
+    def in_shard(self, filenames):
+        """
+        Yields the files which are in our shard.
+        """
+        index, count = self.shard
+        for filename in filenames:
+            if in_shard(filename, index, count):
+                yield filename
+            else:
+                self.stats['skipped (other shards)'] += 1
+
+    def triage(self, filenames):
+        """
+        Works out which of the files actually need to be parsed.
+
+        Skips files in which the prefilter finds nothing the selectors could match,
+        and files which the cache says need no changes (or, if there's a --timeout,
+        took too long last time).
+        Yields the remaining filenames, and puts their keys in `cache_keys`.
+        """
+        for filename in filenames:
+            if self.prefilter is None and self.cache is None:
+                yield filename
+                continue
+
+            try:
+                content = self.read_bytes(filename)
+            except (OSError, subprocess.CalledProcessError):
+                # refactor_file() will report this
+                yield filename
+                continue
+
+            if self.prefilter is not None and not self.prefilter.search(content):
+                self.stats['skipped (pre-filter)'] += 1
+                continue
+
+            if self.cache is not None:
+                key = self.cache.key(content)
+                status, timeout = self.cache.get(key)
+                if status == ResultCache.CLEAN:
+                    self.stats['skipped (cached)'] += 1
+                    continue
+                if (
+                    status == ResultCache.TIMED_OUT
+                    and self.timeout
+                    and timeout is not None
+                    and self.timeout <= timeout
+                ):
+                    # With more time, it's worth another try
+                    self.stats['skipped (timed out before)'] += 1
+                    continue
+                self.cache_keys[filename] = key
+
+            yield filename
+
+    def refactor(self, items, *a, **k):
+        try:
+            self.refactor_files(items)
+        finally:
+            if self.written:
+                # All at once, which is a lot quicker than after every write
+                self.timed('write', sync_files)(self.written)
+                self.stats['files synced'] += len(self.written)
+                self.written = []
+
+    def refactor_files(self, items):
+        filenames = self.iter_filenames(items)
+        if self.shard is not None:
+            filenames = self.in_shard(filenames)
+        if self.counter is not None:
+            filenames = self.counter.sample(filenames)
+        filenames = self.triage(filenames)
+
+        if self.jobs > 1:
+            results = self.refactor_parallel(filenames)
+        else:
+            results = (
+                (filename, *self.refactor_one(filename)) for filename in filenames
+            )
+
+        for filename, hunks, exc in results:
+            self.stats['files processed'] += 1
+            cache_key = self.cache_keys.pop(filename, None)
+            if self.report_out is not None:
+                self.reporter.write(self.report_out, filename, exc)
+            if self.counter is not None and (exc is not None or hunks is None):
+                # We don't know what's in it, so it's not part of the sample
+                self.counter.drop(filename)
+            if isinstance(exc, FileTimedOut):
+                # The file is left alone. That's not an error, but worth a mention.
+                log.warning(f"Skipping {exc}")
+                self.stats['timed out'] += 1
+                if cache_key is not None:
+                    self.cache.put(cache_key, ResultCache.TIMED_OUT, self.timeout)
+                continue
+            if exc:
+                self.log_error(f"{type(exc).__name__}: {exc}")
+                if exc.__cause__:
+                    self.log_error(f"  {type(exc.__cause__).__name__}: {exc.__cause__}")
+                if isinstance(exc, BowlerException) and exc.hunks:
+                    diff = "\n".join("\n".join(hunk) for hunk in exc.hunks)
+                    self.log_error(f"Generated transform:\n{diff}")
+                self.exceptions.append(exc)
+                continue
+
+            if self.counter is not None:
+                if hunks is not None:
+                    self.counter.add(filename, hunks)
+                continue
+
+            if hunks == [] and cache_key is not None:
+                self.cache.put(cache_key, ResultCache.CLEAN)
+
+            if self.check:
+                for change in hunks or []:
+                    self.stats['would change'] += 1
+                    if not self.silent:
+                        print(change)
+                if hunks and self.fail_fast:
+                    break
+                continue
+
+            try:
+                self.process_hunks(filename, hunks or [])
+            except BowlerQuit:
+                break
+
+    def run(self, paths):
+        status = super().run(paths)
+        if self.check and self.stats['would change']:
+            return 1
+        return status
+
+    def summarize(self):
+        if self.cache is not None:
+            self.cache.close()
+        if self.silent:
+            return
+        if self.counter is not None:
+            self.counter.report()
+        if self.show_timings:
+            timings = ', '.join(
+                f'{phase} {self.timings[phase]:.2f}s' for phase in self.PHASES
+            )
+            print(f'decrapify: {timings}', file=sys.stderr)
+        if self.profiler is not None:
+            self.profiler.report()
+            if self.profile_stats_file:
+                self.profiler.dump_stats(self.profile_stats_file)
+                print(
+                    f'decrapify: wrote profile to {self.profile_stats_file}',
+                    file=sys.stderr,
+                )
+        if self.stats:
+            summary = ', '.join(
+                f'{what}: {count}' for what, count in sorted(self.stats.items())
+            )
+            print(f'decrapify: {summary}', file=sys.stderr)
+
+
+def shard_spec(value):
+    """
+    Parses a --shard, e.g. '2/5'. Returns (index, count).
+    """
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"should be I/N, e.g. 2/5: {value!r}")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"should be from 1/N to N/N: {value}")
+    return index, count
+
+
+def positive_int(value):
+    """
+    Parses a whole number which is at least 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a whole number: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"should be at least 1: {value}")
+    return number
+
+
+def sample_fraction(value):
+    """
+    Parses a --sample fraction, e.g. '5%' or '0.05'.
+    """
+    try:
+        if value.endswith('%'):
+            fraction = float(value[:-1]) / 100
+        else:
+            fraction = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a fraction or percentage: {value!r}")
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError(f"should be more than 0%, up to 100%: {value}")
+    return fraction
+
+
+def add_run_arguments(parser):
+    """
+    Adds the options for applying scripts, shared by the `run` command and
+    the commands for each script.
+    """
+    parser.add_argument(
+        '--enable',
+        metavar='RULE',
+        action='append',
+        help=(
+            "Only apply this rule (one of the scripts' selectors, named after what "
+            "it does, e.g. make_dict_comprehension). Can be given more than once."
+        ),
+    )
+    parser.add_argument(
+        '--disable',
+        metavar='RULE',
+        action='append',
+        default=[],
+        help="Don't apply this rule. Can be given more than once.",
+    )
+    parser.add_argument(
+        '--no-input',
+        dest='interactive',
+        default=True,
+        action='store_false',
+        help="Non-interactive mode",
+    )
+    parser.add_argument(
+        '--no-write',
+        dest='write',
+        default=True,
+        action='store_false',
+        help="Don't write the changes to the source file, just output a diff to stdout",
+    )
+    parser.add_argument(
+        '--check',
+        default=False,
+        action='store_true',
+        help=(
+            "Don't change anything; list the files which would be changed, and exit "
+            "with status 1 if there are any. Stops looking at each file once it "
+            "finds something to change."
+        ),
+    )
+    parser.add_argument(
+        '--fail-fast',
+        default=False,
+        action='store_true',
+        help="With --check: stop at the first file which would be changed",
+    )
+    parser.add_argument(
+        '--count',
+        default=False,
+        action='store_true',
+        help=(
+            "Don't change anything; count what each selector matches, in total and "
+            "per directory. (The scripts might decide against changing some of it.)"
+        ),
+    )
+    parser.add_argument(
+        '--sample',
+        type=sample_fraction,
+        metavar='FRACTION',
+        help=(
+            "With --count: only look at this proportion of the files (e.g. 5%%), "
+            "chosen at random, and estimate the totals from them"
+        ),
+    )
+    parser.add_argument(
+        '--sample-seed',
+        type=int,
+        default=0,
+        metavar='N',
+        help="With --sample: a different N chooses different files",
+    )
+    parser.add_argument(
+        '--shard',
+        type=shard_spec,
+        metavar='I/N',
+        help=(
+            "Only process the files in the Ith of N shards, chosen by a hash of "
+            "their paths; e.g. on each of N machines, with `merge` to combine the "
+            "results"
+        ),
+    )
+    parser.add_argument(
+        '--patch-out',
+        metavar='FILE',
+        help=(
+            "Instead of changing the source files, write the changes to FILE, "
+            "as one patch which `git apply` can apply"
+        ),
+    )
+    parser.add_argument(
+        '--output-dir',
+        metavar='DIR',
+        help=(
+            "Instead of changing the source files, write the changed files to the "
+            "same paths (relative to the current directory) under DIR"
+        ),
+    )
+    parser.add_argument(
+        '--fsync',
+        default=False,
+        action='store_true',
+        help="Make sure the files written have reached the disk (all at the end)",
+    )
+    parser.add_argument(
+        '--report-jsonl',
+        metavar='FILE',
+        help=(
+            "Write a JSON line to FILE for every rewrite made or skipped: the file, "
+            "line span, script and callback, code before and after, and (where "
+            "known) why it was skipped"
+        ),
+    )
+    parser.add_argument(
+        '--debug',
+        dest='debug',
+        default=False,
+        action='store_true',
+        help="Spit out debugging information",
+    )
+    parser.add_argument(
+        '--skip-multiline-expressions',
+        default=False,
+        action='store_true',
+        help="Passed on to pytestify.py: skip lines that contain multiline expressions.",
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help="Number of files to process in parallel. 0 means one per CPU.",
+    )
+    parser.add_argument(
+        '--max-files-per-worker',
+        type=int,
+        metavar='N',
+        help="With --jobs, replace the worker processes after one has done N files",
+    )
+    parser.add_argument(
+        '--max-worker-memory',
+        type=int,
+        metavar='MB',
+        help=(
+            "With --jobs, replace the worker processes after one has grown to "
+            "MB megabytes"
+        ),
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        metavar='SECONDS',
+        help=(
+            "Give up on (and leave alone) any file which takes longer than this. "
+            "With --cache, such files are skipped next time."
+        ),
+    )
+    parser.add_argument(
+        '--until-stable',
+        default=False,
+        action='store_true',
+        help=(
+            "Keep applying the scripts to each file until nothing changes, in case "
+            "one change makes another possible"
+        ),
+    )
+    parser.add_argument(
+        '--max-passes',
+        type=positive_int,
+        default=10,
+        metavar='N',
+        help="With --until-stable: give up on a file after N passes (default: 10)",
+    )
+    parser.add_argument(
+        '--engine',
+        choices=('auto', 'cst', 'verify'),
+        default='auto',
+        help=(
+            "Scripts with a faster way than parsing each file (debytesify, when "
+            "it's applied on its own) use it with 'auto'. 'cst' always parses, "
+            "and 'verify' does both and fails files where the results differ."
+        ),
+    )
+    parser.add_argument(
+        '--no-prefilter',
+        dest='prefilter',
+        default=True,
+        action='store_false',
+        help="Parse every file, even those which obviously contain nothing to change",
+    )
+    parser.add_argument(
+        '--timings',
+        default=False,
+        action='store_true',
+        help="At the end, show how much time was spent in each phase of processing",
+    )
+    parser.add_argument(
+        '--profile',
+        default=False,
+        action='store_true',
+        help=(
+            "At the end, show statistics for each selector and the slowest files, "
+            "including their peak memory use. Slows everything down a lot."
+        ),
+    )
+    parser.add_argument(
+        '--profile-stats',
+        metavar='FILE',
+        help="With --profile: also write cProfile stats (for pstats/snakeviz) to FILE",
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='FILE',
+        help=(
+            "Remember files which needed no changes in this sqlite file, "
+            "and skip them on later runs if they haven't changed."
+        ),
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=200000,
+        help="Maximum number of files to remember in the --cache file",
+    )
+    parser.add_argument(
+        '--since',
+        metavar='REF',
+        help=(
+            "Only process files which have changed since the given git ref. "
+            "If files/directories are given too, only changed files in those."
+        ),
+    )
+    parser.add_argument(
+        '--staged',
+        default=False,
+        action='store_true',
+        help=(
+            "Only process files with staged changes, and work on the staged content "
+            "(files with unstaged changes aren't written to)"
+        ),
+    )
+    parser.add_argument(
+        '--changed-lines-only',
+        default=False,
+        action='store_true',
+        help="With --since/--staged: leave alone anything not on a changed line",
+    )
+    parser.add_argument(
+        '--exclude',
+        metavar='GLOB',
+        action='append',
+        default=[],
+        help=(
+            "Skip files and directories matching this glob (by name, or by path "
+            "relative to the directory being searched). Can be given more than once."
+        ),
+    )
+    parser.add_argument(
+        '--no-gitignore',
+        dest='gitignore',
+        default=True,
+        action='store_false',
+        help="Search directories for python files regardless of .gitignore files",
+    )
+    parser.add_argument(
+        'files',
+        nargs='*',
+        help=(
+            "The python source file(s) or directories to operate on. "
+            "'-' reads a NUL-delimited list of them (e.g. from find -print0) from "
+            "stdin, and '@FILE' reads one from FILE."
+        ),
+    )
+
+
+def run_command(parser, args):
+    """
+    Applies the scripts in args.fixers, as the command line says.
+    """
+    use_git = args.since or args.staged
+    if not args.files and not use_git:
+        parser.error("the following arguments are required: files")
+    if args.changed_lines_only and not use_git:
+        parser.error("--changed-lines-only needs --since or --staged")
+    if args.profile_stats and not args.profile:
+        parser.error("--profile-stats needs --profile")
+    if args.fail_fast and not args.check:
+        parser.error("--fail-fast needs --check")
+    if args.check and args.patch_out:
+        parser.error("--check and --patch-out can't be used together")
+    if args.check and args.output_dir:
+        parser.error("--check and --output-dir can't be used together")
+    if args.patch_out and args.output_dir:
+        parser.error("--patch-out and --output-dir can't be used together")
+    if args.timeout is not None and not hasattr(signal, 'setitimer'):
+        parser.error("--timeout isn't supported on this platform")
+    if args.check and args.engine == 'verify':
+        parser.error("--check and --engine=verify can't be used together")
+    if args.sample is not None and not args.count:
+        parser.error("--sample needs --count")
+    if args.count:
+        for option in ('check', 'patch_out', 'output_dir', 'cache', 'report_jsonl'):
+            if getattr(args, option):
+                parser.error(
+                    f"--count and --{option.replace('_', '-')} can't be used together"
+                )
+    if args.check or args.count:
+        args.write = args.interactive = False
+    writes = args.write or args.patch_out or args.output_dir
+    if '-' in args.files and args.interactive and writes:
+        parser.error("reading files from stdin needs --no-input")
+
+    rules = None
+    if args.enable or args.disable:
+        fixers = load_fixers(args.fixers)
+        known = [name for fixer in fixers for name in rule_names(fixer)]
+        unknown = set(args.enable or ()).union(args.disable).difference(known)
+        if unknown:
+            parser.error(
+                f"unknown rules: {', '.join(sorted(unknown))} "
+                f"(the rules for {', '.join(args.fixers)} are: {', '.join(known)})"
+            )
+        rules = enabled_rules(known, args.enable, args.disable)
+        if not rules:
+            parser.error("no rules are left to apply")
+
+    files = expand_arguments(args.files)
+    changed_lines = None
+    if use_git:
+        paths = list(files)
+        files = [
+            filename
+            for filename in git_changed_files(paths, args.since, args.staged)
+            if filename.endswith('.py')
+        ]
+        if args.changed_lines_only:
+            changed_lines = git_changed_lines(paths, args.since, args.staged)
+
+    flags = {
+        'debug': args.debug,
+        'skip_multiline_expressions': args.skip_multiline_expressions,
+    }
+    cache = None
+    if args.cache:
+        cache = ResultCache(
+            args.cache,
+            load_fixers(args.fixers),
+            flags,
+            rules=rules,
+            max_entries=args.cache_size,
+            # A file with nothing to change on its changed lines might still
+            # have something to change elsewhere.
+            read_only=args.changed_lines_only,
+        )
+
+    patch_out = None
+    if args.patch_out:
+        patch_out = open(args.patch_out, 'wb')
+    report_out = None
+    if args.report_jsonl:
+        report_out = open(args.report_jsonl, 'w', encoding='utf-8')
+    # Changes go to the patch (or the output directory) instead of the files,
+    # but are otherwise accepted or not in the same way.
+    write = bool(writes)
+
+    tool = build_tool(
+        args.fixers,
+        flags,
+        # interactive diff implies write (for the bits the user says 'y' to)
+        interactive=(args.interactive and write),
+        write=write,
+        jobs=args.jobs or os.cpu_count() or 1,
+        max_files_per_worker=args.max_files_per_worker,
+        max_worker_memory=(
+            args.max_worker_memory and args.max_worker_memory * 1024 * 1024
+        ),
+        cache=cache,
+        prefilter=args.prefilter,
+        staged=args.staged,
+        changed_lines=changed_lines,
+        show_timings=args.timings,
+        profile=args.profile,
+        profile_stats=bool(args.profile_stats),
+        profile_stats_file=args.profile_stats,
+        exclude=args.exclude,
+        gitignore=args.gitignore,
+        patch_out=patch_out,
+        output_dir=args.output_dir,
+        fsync=args.fsync,
+        report=report_out is not None,
+        report_out=report_out,
+        check=args.check,
+        fail_fast=args.fail_fast,
+        timeout=args.timeout,
+        until_stable=args.until_stable,
+        max_passes=args.max_passes,
+        engine=args.engine,
+        rules=rules,
+        count=args.count,
+        sample=args.sample,
+        sample_seed=args.sample_seed,
+        shard=args.shard,
+    )
+    # Actually run everything, on a single parse of each file.
+    try:
+        sys.exit(tool.run(files))
+    finally:
+        for f in (patch_out, report_out):
+            if f is not None:
+                f.close()
+
+
+def merge_command(parser, args):
+    """
+    Combines the patches (or reports) from several --shard runs into one.
+    """
+    if bool(args.patch_out) == bool(args.report_jsonl):
+        parser.error("one of --patch-out and --report-jsonl is required")
+    split = split_patch if args.patch_out else split_report
+    inputs = {}
+    for filename in args.files:
+        first = inputs.setdefault(os.path.realpath(filename), filename)
+        if first != filename or args.files.count(filename) > 1:
+            parser.error(f"{filename} is given more than once")
+
+    # Maps each path to the first input it's in, and what the inputs say about it
+    found = {}
+    pieces = defaultdict(list)
+    conflicts = set()
+    for filename in args.files:
+        with open(filename, 'rb') as f:
+            content = f.read()
+        try:
+            for path, piece in split(content):
+                path = os.path.normpath(path)
+                first = found.setdefault(path, filename)
+                # A report has several lines for a file, but a patch only one
+                repeated = first != filename or (split is split_patch and pieces[path])
+                if repeated and (path, filename) not in conflicts:
+                    if first == filename:
+                        log.error(f"{path} is in {filename} more than once")
+                    else:
+                        log.error(f"{path} is in both {first} and {filename}")
+                    conflicts.add((path, filename))
+                pieces[path].append(piece)
+        except ValueError as e:
+            parser.error(f"{filename}: {e}")
+    if conflicts:
+        num_files = len({path for path, filename in conflicts})
+        log.error(f"Not merging: {num_files} files are given more than once")
+        sys.exit(1)
+
+    # The order a single run over the same directory would have written them in
+    paths = sorted(pieces, key=lambda path: path.split(os.sep))
+    with open(args.patch_out or args.report_jsonl, 'wb') as f:
+        for path in paths:
+            f.write(b''.join(pieces[path]))
+    print(f"decrapify: merged {len(paths)} files from {len(args.files)} shards")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Applies decrapify scripts to your code, parsing each file only once."
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    run_parser = subparsers.add_parser(
+        'run',
+        help="Apply several scripts at once (the default)",
+        description="Applies several decrapify scripts at once, parsing each file only once.",
+    )
+    run_parser.add_argument(
+        '-f',
+        '--fixer',
+        dest='fixers',
+        action='append',
+        choices=FIXERS,
+        required=True,
+        help="A script to apply. Give this more than once to apply several at once.",
+    )
+    add_run_arguments(run_parser)
+    run_parser.set_defaults(func=run_command, parser=run_parser)
+
+    for name in FIXERS:
+        fixer_parser = subparsers.add_parser(
+            name, help=f"Apply {name}.py", description=f"Applies {name}.py."
+        )
+        add_run_arguments(fixer_parser)
+        fixer_parser.set_defaults(func=run_command, parser=fixer_parser, fixers=[name])
+
+    merge_parser = subparsers.add_parser(
+        'merge',
+        help="Combine the patches or reports from several --shard runs",
+        description=(
+            "Combines the --patch-out patches (or --report-jsonl reports) from "
+            "several --shard runs into one, in a stable order. Fails if a file is "
+            "in more than one of them."
+        ),
+    )
+    merge_parser.add_argument(
+        '--patch-out', metavar='FILE', help="Merge patches, and write them to FILE"
+    )
+    merge_parser.add_argument(
+        '--report-jsonl', metavar='FILE', help="Merge reports, and write them to FILE"
+    )
+    merge_parser.add_argument(
+        'files', metavar='SHARD_FILE', nargs='+', help="The patches or reports"
+    )
+    merge_parser.set_defaults(func=merge_command, parser=merge_parser)
+
+    argv = sys.argv[1:] if argv is None else argv
+    # Before there were commands, everything was `run`
+    if argv and argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['run', *argv]
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+    args.func(args.parser, args)
+
+
+if __name__ == '__main__':
+    main()
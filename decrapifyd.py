@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+A server which applies decrapify scripts to source code sent to it, so editors and
+pre-commit hooks don't pay for starting python, importing everything and compiling
+the selectors on every call. In the spirit of blackd.
+
+    ./decrapifyd.py --socket /tmp/decrapifyd.sock &
+    curl --unix-socket /tmp/decrapifyd.sock -H 'X-Fixers: fstrings,py3cleanup' \\
+        --data-binary @mymodule.py http://localhost/
+
+POST the source as the request body. Headers:
+
+    X-Fixers: the scripts to apply, separated by commas (required)
+    X-Diff: if set, respond with a unified diff instead of the new source
+    X-Filename: the filename to use in the diff
+    X-Skip-Multiline-Expressions: if set, passed on to pytestify
+
+Responses:
+
+    200: the changed source (or the diff)
+    204: nothing to change
+    400: bad request, or the source couldn't be parsed
+    500: the scripts failed, or produced invalid code
+"""
+
+import argparse
+import difflib
+import io
+import logging
+import os
+import signal
+import socketserver
+import sys
+import time
+import tokenize
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import decrapify
+
+log = logging.getLogger('decrapifyd')
+
+
+class BadRequest(Exception):
+    pass
+
+
+class TransformFailed(Exception):
+    pass
+
+
+class Transformer:
+    """
+    Keeps a DecrapifyTool for each combination of scripts and flags asked for,
+    so each is only set up once.
+    """
+
+    def __init__(self):
+        self.tools = {}
+
+    def get_tool(self, fixer_names, flags):
+        key = (tuple(fixer_names), tuple(sorted(flags.items())))
+        if key not in self.tools:
+            self.tools[key] = decrapify.build_tool(
+                fixer_names, flags, interactive=False, write=False, silent=True
+            )
+        # The flags are module-level, so might have been changed by another tool
+        for fixer in decrapify.load_fixers(fixer_names):
+            fixer.flags.update(flags)
+        return self.tools[key]
+
+    def transform(self, source, fixer_names, flags, filename):
+        """
+        Applies the scripts to `source` (a str), returning the new source.
+        """
+        tool = self.get_tool(fixer_names, flags)
+        input = source if source.endswith('\n') else source + '\n'
+        tree = tool.refactor_string(input, filename)
+        if tree is None:
+            # refactor_string() logs the details
+            raise BadRequest(f"Couldn't parse {filename}")
+        try:
+            output = str(tree)
+        finally:
+            # Otherwise it hangs around until the next full garbage collection
+            decrapify.release_tree(tree)
+        if output == input:
+            return source
+        try:
+            decrapify.release_tree(tool.driver.parse_string(output))
+        except Exception as e:
+            raise TransformFailed(f"Transforms generated invalid code: {e}") from e
+        if not source.endswith('\n'):
+            output = output[:-1]
+        return output
+
+
+class DecrapifyHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        start = time.perf_counter()
+        try:
+            response = self.handle_source()
+        except BadRequest as e:
+            self.respond(400, str(e).encode())
+        except TransformFailed as e:
+            self.respond(500, str(e).encode())
+        except Exception as e:
+            log.exception("Failed to transform source")
+            self.respond(500, f"{type(e).__name__}: {e}".encode())
+        else:
+            if response is None:
+                self.respond(204, b'')
+            else:
+                self.respond(200, response)
+        log.debug(f"Handled request in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def handle_source(self):
+        """
+        Returns the response body, or None if there's nothing to change.
+        """
+        fixer_names = [
+            name.strip()
+            for name in self.headers.get('X-Fixers', '').split(',')
+            if name.strip()
+        ]
+        if not fixer_names:
+            raise BadRequest("X-Fixers is required")
+        unknown = set(fixer_names) - set(decrapify.FIXERS)
+        if unknown:
+            raise BadRequest(f"Unknown fixers: {', '.join(sorted(unknown))}")
+        # Applied in the usual order, whatever order they're given in
+        fixer_names = [name for name in decrapify.FIXERS if name in fixer_names]
+
+        flags = {
+            'debug': False,
+            'skip_multiline_expressions': bool(
+                self.headers.get('X-Skip-Multiline-Expressions')
+            ),
+        }
+        filename = self.headers.get('X-Filename', 'source.py')
+
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            encoding = tokenize.detect_encoding(io.BytesIO(content).readline)[0]
+            source = content.decode(encoding)
+        except (SyntaxError, UnicodeDecodeError) as e:
+            raise BadRequest(f"Couldn't decode source: {e}")
+
+        new_source = self.server.transformer.transform(
+            source, fixer_names, flags, filename
+        )
+        if new_source == source:
+            return None
+        if self.headers.get('X-Diff'):
+            diff = difflib.unified_diff(
+                source.splitlines(keepends=True),
+                new_source.splitlines(keepends=True),
+                filename,
+                filename,
+            )
+            return ''.join(diff).encode(encoding)
+        return new_source.encode(encoding)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        # A 204 has no body, so nothing to say about it
+        if status != 204:
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+        try:
+            self.end_headers()
+            if status != 204:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug("The client hung up before reading the response")
+
+    def address_string(self):
+        # Unix sockets don't have a (host, port) address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'local'
+
+    def log_message(self, format, *args):
+        log.info(f"{self.address_string()} {format % args}")
+
+
+class DecrapifyServer(HTTPServer):
+    # Requests are handled one at a time, since the fixers keep module-level state
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.transformer = Transformer()
+
+
+class UnixDecrapifyServer(socketserver.UnixStreamServer, DecrapifyServer):
+    def server_bind(self):
+        # HTTPServer.server_bind() expects a (host, port) address
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Applies decrapify scripts to source code POSTed to it."
+    )
+    parser.add_argument(
+        '--bind-host', default='localhost', help="Address to listen on"
+    )
+    parser.add_argument('--bind-port', type=int, default=45484, help="Port to listen on")
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help="Listen on this unix socket instead of a TCP port",
+    )
+    parser.add_argument(
+        '--preload',
+        metavar='FIXER',
+        action='append',
+        choices=decrapify.FIXERS,
+        default=[],
+        help="Set up this script before the first request. Can be given more than once.",
+    )
+    parser.add_argument(
+        '--debug',
+        default=False,
+        action='store_true',
+        help="Log every request, and how long it took",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(name)s %(message)s',
+    )
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixDecrapifyServer(args.socket, DecrapifyHandler)
+        address = args.socket
+    else:
+        server = DecrapifyServer((args.bind_host, args.bind_port), DecrapifyHandler)
+        address = f'http://{args.bind_host}:{args.bind_port}/'
+
+    if args.preload:
+        fixer_names = [name for name in decrapify.FIXERS if name in args.preload]
+        server.transformer.get_tool(
+            fixer_names, {'debug': False, 'skip_multiline_expressions': False}
+        )
+
+    # Clean up properly when killed, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log.info(f"Listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,14 +13,18 @@ Implemented:
     * 'stringliteral {} {bar}'.format(foo, bar=bar)
         --> f'stringliteral {foo} {bar}'
 
+    * '{!r:>20}'.format(foo)
+        --> f'{foo!r:>20}'
+
 TODO: plenty:
     * Handle other printf-style things other than %s/%d/%f, e.g. '%20d' etc.
-    * Same for .format() - handle '!20d' etc
     * Handle old-style dict interpolation, e.g. '%(a)s' % {'a': 'a'}
 """
 
 import argparse
+import functools
 import re
+import string
 import sys
 
 from bowler import Query, TOKEN, SYMBOL
@@ -28,19 +32,31 @@ from bowler.types import Leaf, Node, STARS
 
 flags = {}
 
+# If set, called with (node, reason) whenever an expression is left alone.
+# decrapify.py uses this for --report-jsonl.
+skip_hook = None
+
+# Any interpolation we could convert needs a '%' or a '.format'
+PREFILTER = re.compile(rb'%|\bformat\b')
 
-RE_OLD_INTERPOLATION_BASIC = re.compile(r'(?<!%)%[fds]')
 
-# TODO: currently excludes modifiers like `{!d}`
-# TODO/FIXME: what's the syntax for a negative lookahead? Need to avoid matching '}}' escape.
-# No 're' docs on my flight :(
-RE_NEW_INTERPOLATION_BASIC = re.compile(r'(?<!{)\{[^{}!]*\}')
+# Every '%' in an old-style format string starts either a placeholder or a '%%'
+RE_OLD_INTERPOLATION = re.compile(r'%(.?)', re.DOTALL)
 
 RE_STRING_LITERAL_PREFIX = re.compile(r'^([uUrRbBfF]*)(.*)$')
 
 
 class SkipString(ValueError):
-    pass
+    """
+    Raised when an expression can't be converted. The message says why.
+    """
+
+
+def skipped(node, reason):
+    if flags['debug']:
+        print(f"Skipping {str(node).strip()}: {reason}")
+    if skip_hook is not None:
+        skip_hook(node, str(reason))
 
 
 def add_f_prefix(string_value):
@@ -50,7 +66,7 @@ def add_f_prefix(string_value):
     match = RE_STRING_LITERAL_PREFIX.match(string_value)
     if not match:
         # huh?
-        raise SkipString
+        raise SkipString("unrecognised string literal")
 
     current_prefix = match.group(1)
     the_rest = match.group(2)
@@ -60,7 +76,7 @@ def add_f_prefix(string_value):
     # https://docs.python.org/3/reference/lexical_analysis.html#strings
     # The 'f' may be combined with 'r', but not with 'b' or 'u'
     if 'b' in current_prefix.lower():
-        raise SkipString
+        raise SkipString("bytes literals can't be f-strings")
 
     prefix = current_prefix
     if 'u' in current_prefix.lower():
@@ -70,6 +86,133 @@ def add_f_prefix(string_value):
     return f'f{prefix}{the_rest}'
 
 
+def escape_braces(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+# The same format strings tend to turn up over and over (e.g. in log messages),
+# so the parsing and conversion of them is cached.
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_old_format_string(literal):
+    """
+    Parses an old-style format string, e.g. `'foo %s'` in `'foo %s' % bar`.
+
+    Returns the text around the placeholders (so, one more piece of text than
+    there are placeholders), escaped for use in an f-string.
+    """
+    pieces = []
+    text = ''
+    position = 0
+    for match in RE_OLD_INTERPOLATION.finditer(literal):
+        text += literal[position : match.start()]
+        position = match.end()
+        conversion = match.group(1)
+        if conversion == '%':
+            text += '%'
+        elif conversion and conversion in 'dfs':
+            pieces.append(escape_braces(text))
+            text = ''
+        else:
+            # TODO: e.g. '%.20f' could be f'{foo:.20f}'
+            raise SkipString(f"unsupported placeholder: %{conversion}")
+    pieces.append(escape_braces(text + literal[position:]))
+    return tuple(pieces)
+
+
+@functools.lru_cache(maxsize=4096)
+def convert_old_format_string(literal, names):
+    """
+    Converts `literal % (names...)` to an f-string.
+
+    Returns (f-string, None), or (None, reason) if it can't be done.
+    """
+    try:
+        pieces = parse_old_format_string(literal)
+        if len(pieces) - 1 != len(names):
+            # This could be a bug in the program, but more likely the
+            # thing on the right isn't a tuple of plain names.
+            raise SkipString("arguments don't match the %-placeholders")
+        fields = ['{%s}' % name for name in names] + ['']
+        return add_f_prefix(''.join(p + f for p, f in zip(pieces, fields))), None
+    except SkipString as e:
+        return None, str(e)
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_new_format_string(literal):
+    """
+    Parses a new-style format string, e.g. `'{} {foo!r}'` in `'{} {foo!r}'.format(...)`.
+
+    Returns a tuple of (text, key, suffix) for each field: the text before the field
+    (escaped for use in an f-string), which argument goes in the field (an index or
+    a keyword; None after the last field) and the field's conversion and format spec.
+    """
+    try:
+        parsed = list(string.Formatter().parse(literal))
+    except ValueError as e:
+        raise SkipString(f"invalid format string ({e})")
+
+    pieces = []
+    next_index = 0
+    numbering = set()
+    for text, field_name, spec, conversion in parsed:
+        key = None
+        suffix = ''
+        if field_name is not None:
+            if field_name == '':
+                key = next_index
+                next_index += 1
+                numbering.add('automatic')
+            elif field_name.isdigit():
+                key = int(field_name)
+                numbering.add('manual')
+            elif field_name.isidentifier():
+                key = field_name
+            else:
+                raise SkipString(f"field isn't a plain name or number: {field_name}")
+            if '{' in spec:
+                raise SkipString("nested field in format spec")
+            if conversion:
+                suffix += '!' + conversion
+            if spec:
+                suffix += ':' + spec
+        pieces.append((escape_braces(text), key, suffix))
+
+    if len(numbering) > 1:
+        raise SkipString("mixes automatic and manual field numbering")
+    return tuple(pieces)
+
+
+@functools.lru_cache(maxsize=4096)
+def convert_new_format_string(literal, positional_args, keyword_args):
+    """
+    Converts `literal.format(*positional_args, **dict(keyword_args))` to an f-string.
+
+    Returns (f-string, None), or (None, reason) if it can't be done.
+    """
+    keyword_args = dict(keyword_args)
+    try:
+        result = ''
+        for text, key, suffix in parse_new_format_string(literal):
+            result += text
+            if key is None:
+                continue
+            if isinstance(key, int):
+                if key >= len(positional_args):
+                    raise SkipString("not enough arguments for the format string")
+                value = positional_args[key]
+            else:
+                if key not in keyword_args:
+                    raise SkipString(f"no argument for {{{key}}}")
+                value = keyword_args[key]
+            result += '{' + value + suffix + '}'
+        return add_f_prefix(result), None
+    except SkipString as e:
+        return None, str(e)
+
+
 def old_interpolation_to_fstrings(node, capture, filename):
     """
     '%s' % xyz
@@ -91,28 +234,13 @@ def old_interpolation_to_fstrings(node, capture, filename):
             if isinstance(o, Leaf) and o.type == TOKEN.NAME
         ]
 
-    if len(RE_OLD_INTERPOLATION_BASIC.findall(formatstring.value)) != len(interpolation_args):
-        # TODO: The arguments don't line up 1:1 with the number of '%s' bits.
-        # This could be a bug in the program.
-        # More likely, it's because our regex isn't that inclusive.
-        # e.g. if one of them is '%.20f' we'll miss that one and skip the whole expression.
-        # We could implement this, by using f'{foo!.20f}' for that case.
-        return node
-
-    # Replace all occurrences of '%s' in the formatstring with the matching '{argumentname}'
-    replacement_value = RE_OLD_INTERPOLATION_BASIC.sub(
-        lambda matchobj: ('{%s}' % interpolation_args.pop(0)),
-        formatstring.value,
+    # Replace each '%s' in the formatstring with the matching '{argumentname}'
+    replacement_value, reason = convert_old_format_string(
+        formatstring.value, tuple(interpolation_args)
     )
-
-    # Make sure we consumed all the arguments, otherwise something went wrong.
-    assert not interpolation_args
-
-    # Convert to an f-string.
-    try:
-        replacement_value = add_f_prefix(replacement_value)
-    except SkipString:
-        return node
+    if replacement_value is None:
+        skipped(node, reason)
+        return
 
     if flags['debug']:
         print(f"Interpolating (old-style) format-string:\n\t{formatstring}")
@@ -124,8 +252,6 @@ def old_interpolation_to_fstrings(node, capture, filename):
     formatstring.value = replacement_value
     node.children[1:] = []
 
-    return node
-
 
 def _interpret_format_arguments(arg):
     """
@@ -160,7 +286,7 @@ def _interpret_format_arguments(arg):
         if arg.children[0].type in STARS:
             # *args, or **kwargs.
             # Not useful for f-stringing. Give up.
-            raise SkipString
+            raise SkipString("*args or **kwargs")
 
         # Single keyword argument: .format(keyword=value)
         # The three child nodes here are (keyword, '=', value).
@@ -168,7 +294,7 @@ def _interpret_format_arguments(arg):
         if not isinstance(value, Leaf):
             # Might be complex? Give up. This stops parsing of the entire expression,
             # beacuse having an f-string *and* a .format() is pretty nasty.
-            raise SkipString
+            raise SkipString("keyword argument value isn't a single token")
         else:
             yield {
                 arg.children[0].value: value.value
@@ -180,7 +306,7 @@ def _interpret_format_arguments(arg):
         # Something else.
         # Might be a complex expression? Give up. This stops parsing of the entire expression,
         # because having an f-string *and* a .format() is pretty nasty.
-        raise SkipString
+        raise SkipString("positional argument isn't a plain name")
 
 
 def format_method_to_fstrings(node, capture, filename):
@@ -207,35 +333,80 @@ def format_method_to_fstrings(node, capture, filename):
             if parsed_arg is None:
                 # This arg was deemed too complex to bother pushing into an f-string.
                 # Give up.
-                return node
+                skipped(node, "argument too complex")
+                return
             elif isinstance(parsed_arg, dict):
                 keyword_args.update(parsed_arg)
             else:
                 positional_args.append(parsed_arg)
+    except SkipString as e:
+        skipped(node, e)
+        return
 
-        # Actually push the new names into a new formatstring. Wrap each value with curly braces.
-        replacement_value = formatstring.value.format(
-            *['{%s}' % a for a in positional_args],
-            **{k: '{%s}' % v for (k, v) in keyword_args.items()}
-        )
-
-        # Convert to an f-string
-        replacement_value = add_f_prefix(replacement_value)
-
-        if flags['debug']:
-            print(f"Interpolating (new-style) format-string:\n\t{formatstring}")
-            print(f"With arguments:\n\t{positional_args}, {keyword_args}")
-            print(f"Replacement formatstring: {replacement_value}")
-            print()
+    # Actually push the new names into a new formatstring. Wrap each value with curly braces.
+    replacement_value, reason = convert_new_format_string(
+        formatstring.value,
+        tuple(positional_args),
+        tuple(sorted(keyword_args.items())),
+    )
+    if replacement_value is None:
+        skipped(node, reason)
+        return
 
-    except SkipString:
-        return node
+    if flags['debug']:
+        print(f"Interpolating (new-style) format-string:\n\t{formatstring}")
+        print(f"With arguments:\n\t{positional_args}, {keyword_args}")
+        print(f"Replacement formatstring: {replacement_value}")
+        print()
 
     # Finally, apply the whole thing
     formatstring.value = replacement_value
     capture['trailer1'].remove()
     capture['trailer2'].remove()
-    return node
+
+
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
+        # NOTE: You can append as many .select().modify() bits as you want to one query.
+        # Each .modify() acts only on the .select[_*]() immediately prior.
+
+        # 1. String interpolation (old style):
+        # ... where the thing on the right is a variable name
+        # ... where the thing on the right is a tuple of variable names.
+        .select('''
+            (
+                term<
+                    formatstring=STRING '%' interpolation_args=NAME >
+            |
+                term< formatstring=STRING '%' atom< '('
+                    (testlist_gexp< interpolation_args=((NAME ',')* NAME [',']) >)
+                ')' > >
+            )
+        ''')
+        .modify(callback=old_interpolation_to_fstrings)
+
+        # 2. New-style interpolation (.format(...))
+        # The 'power<>' thing is confusing to me. What's 'power' mean in this context?
+        # NOTE: this selector is quite loose; it accepts 'any*' in the arguments to format().
+        # i.e. this happily accepts: ''.format(a, 2, b=3, c=d[e], *x, **y)
+        # We'll need to be careful handling each of these in the modify callback,
+        # since not all of those args make much sense shoved into an fstring.
+        .select('''
+            function_call=power<
+                formatstring=STRING
+                trailer1=trailer<
+                    '.' 'format'
+                >
+                trailer2=trailer< '(' interpolation_args=any* ')' >
+                any*
+            >
+        ''')
+        .modify(callback=format_method_to_fstrings)
+    )
 
 
 def main():
@@ -275,43 +446,7 @@ def main():
 
     query = (
         # Look for files in the current working directory
-        Query(*args.files)
-
-        # NOTE: You can append as many .select().modify() bits as you want to one query.
-        # Each .modify() acts only on the .select[_*]() immediately prior.
-
-        # 1. String interpolation (old style):
-        # ... where the thing on the right is a variable name
-        # ... where the thing on the right is a tuple of variable names.
-        .select('''
-            (
-                term<
-                    formatstring=STRING '%' interpolation_args=NAME >
-            |
-                term< formatstring=STRING '%' atom< '('
-                    (testlist_gexp< interpolation_args=((NAME ',')* NAME [',']) >)
-                ')' > >
-            )
-        ''')
-        .modify(callback=old_interpolation_to_fstrings)
-
-        # 2. New-style interpolation (.format(...))
-        # The 'power<>' thing is confusing to me. What's 'power' mean in this context?
-        # NOTE: this selector is quite loose; it accepts 'any*' in the arguments to format().
-        # i.e. this happily accepts: ''.format(a, 2, b=3, c=d[e], *x, **y)
-        # We'll need to be careful handling each of these in the modify callback,
-        # since not all of those args make much sense shoved into an fstring.
-        .select('''
-            function_call=power<
-                formatstring=STRING
-                trailer1=trailer<
-                    '.' 'format'
-                >
-                trailer2=trailer< '(' interpolation_args=any* ')' >
-                any*
-            >
-        ''')
-        .modify(callback=format_method_to_fstrings)
+        add_transforms(Query(*args.files))
 
         # Actually run both of the above.
         .execute(
@@ -28,6 +28,9 @@ from bowler.types import Leaf, Node, STARS
 
 flags = {}
 
+# Every cleanup here needs a 'not', a 'None' or some parentheses
+PREFILTER = re.compile(rb'\bnot\b|\bNone\b|\(')
+
 
 def kw(name, **kwargs):
     """
@@ -81,7 +84,6 @@ def simplify_none_operand(node, capture, arguments):
         --> a is not None
     """
     op = capture['op'][0]
-    print(op)
     if op.type == TOKEN.EQEQUAL:
         op.replace(kw('is'))
     else:
@@ -111,7 +113,10 @@ def make_dict_comprehension(node, capture, arguments):
     kv = capture['kv']
     key = capture['k']
     value = capture['v']
-    forloop = capture['forloop'][0]
+    forloop = capture['forloop']
+    if isinstance(forloop, list):
+        # Older versions of fissix capture a parenthesised group as a list
+        forloop = forloop[0]
     ifpart = capture.get('ifpart') or None
 
     forloop.type = syms.comp_for
@@ -142,7 +147,10 @@ def make_dict_comprehension(node, capture, arguments):
 
 def make_set_comprehension(node, capture, arguments):
     arg = capture['arg']
-    forloop = capture['forloop'][0]
+    forloop = capture['forloop']
+    if isinstance(forloop, list):
+        # Older versions of fissix capture a parenthesised group as a list
+        forloop = forloop[0]
     ifpart = capture.get('ifpart') or None
 
     forloop.type = syms.comp_for
@@ -191,42 +199,12 @@ def remove_extra_parentheses(node, capture, arguments):
     node.replace(newnode)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Converts x-unit style tests to be pytest-style where possible."
-    )
-    parser.add_argument(
-        '--no-input',
-        dest='interactive',
-        default=True,
-        action='store_false',
-        help="Non-interactive mode",
-    )
-    parser.add_argument(
-        '--no-write',
-        dest='write',
-        default=True,
-        action='store_false',
-        help="Don't write the changes to the source file, just output a diff to stdout",
-    )
-    parser.add_argument(
-        '--debug',
-        dest='debug',
-        default=False,
-        action='store_true',
-        help="Spit out debugging information",
-    )
-    parser.add_argument(
-        'files', nargs='+', help="The python source file(s) to operate on."
-    )
-    args = parser.parse_args()
-
-    # No way to pass this to .modify() callables, so we just set it at module level
-    flags['debug'] = args.debug
-
-    query = (
-        # Look for files in the current working directory
-        Query(*args.files)
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
         # 'not a == b' --> 'a != b'
         .select(
             '''
@@ -329,6 +307,45 @@ def main():
             """
         )
         .modify(callback=remove_extra_parentheses)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts x-unit style tests to be pytest-style where possible."
+    )
+    parser.add_argument(
+        '--no-input',
+        dest='interactive',
+        default=True,
+        action='store_false',
+        help="Non-interactive mode",
+    )
+    parser.add_argument(
+        '--no-write',
+        dest='write',
+        default=True,
+        action='store_false',
+        help="Don't write the changes to the source file, just output a diff to stdout",
+    )
+    parser.add_argument(
+        '--debug',
+        dest='debug',
+        default=False,
+        action='store_true',
+        help="Spit out debugging information",
+    )
+    parser.add_argument(
+        'files', nargs='+', help="The python source file(s) to operate on."
+    )
+    args = parser.parse_args()
+
+    # No way to pass this to .modify() callables, so we just set it at module level
+    flags['debug'] = args.debug
+
+    query = (
+        # Look for files in the current working directory
+        add_transforms(Query(*args.files))
         # Actually run all of the above.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
@@ -4,6 +4,7 @@ Removes some leftover mess from a transition to python 3.
 """
 
 import argparse
+import re
 from fissix.pygram import python_symbols as syms
 
 from bowler import Query, TOKEN
@@ -11,6 +12,9 @@ from bowler.types import Leaf
 
 flags = {}
 
+# Both cleanups need one of these words somewhere in the file
+PREFILTER = re.compile(rb'\bsuper\b|\bobject\b')
+
 
 def kw(name, **kwargs):
     """
@@ -48,42 +52,12 @@ def remove_explicit_object_superclass(node, capture, arguments):
         param.replace(kwarg)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Removes artifacts from a transition to python 3."
-    )
-    parser.add_argument(
-        '--no-input',
-        dest='interactive',
-        default=True,
-        action='store_false',
-        help="Non-interactive mode",
-    )
-    parser.add_argument(
-        '--no-write',
-        dest='write',
-        default=True,
-        action='store_false',
-        help="Don't write the changes to the source file, just output a diff to stdout",
-    )
-    parser.add_argument(
-        '--debug',
-        dest='debug',
-        default=False,
-        action='store_true',
-        help="Spit out debugging information",
-    )
-    parser.add_argument(
-        'files', nargs='+', help="The python source file(s) to operate on."
-    )
-    args = parser.parse_args()
-
-    # No way to pass this to .modify() callables, so we just set it at module level
-    flags['debug'] = args.debug
-
-    (
-        # Look for files in the current working directory
-        Query(*args.files)
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
         # super(MyClassName, self) --> super()
         # (where MyClassName is the type of self)
         .select(
@@ -119,6 +93,45 @@ def main():
             """
         )
         .modify(callback=remove_explicit_object_superclass)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Removes artifacts from a transition to python 3."
+    )
+    parser.add_argument(
+        '--no-input',
+        dest='interactive',
+        default=True,
+        action='store_false',
+        help="Non-interactive mode",
+    )
+    parser.add_argument(
+        '--no-write',
+        dest='write',
+        default=True,
+        action='store_false',
+        help="Don't write the changes to the source file, just output a diff to stdout",
+    )
+    parser.add_argument(
+        '--debug',
+        dest='debug',
+        default=False,
+        action='store_true',
+        help="Spit out debugging information",
+    )
+    parser.add_argument(
+        'files', nargs='+', help="The python source file(s) to operate on."
+    )
+    args = parser.parse_args()
+
+    # No way to pass this to .modify() callables, so we just set it at module level
+    flags['debug'] = args.debug
+
+    (
+        # Look for files in the current working directory
+        add_transforms(Query(*args.files))
         # Actually run all of the above.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
@@ -14,6 +14,7 @@ For simplicity, doesn't really handle boolean/None values well:
 """
 
 import argparse
+import re
 from functools import wraps
 
 from fissix.fixer_util import (
@@ -165,14 +166,9 @@ def conversion(func):
         if flags["debug"]:
             print("Selected expression: ", list(node.children))
 
-        if capture.get("function_def"):
-            # Not interested in `def assertEqual`, leave that alone.
-            # We only care about *calls*
-            return node
-
         arguments_nodes = capture["function_arguments"]
         if not arguments_nodes:
-            return node
+            return None
 
         # This is wrapped in a list for some reason?
         arguments_node = arguments_nodes[0]
@@ -208,7 +204,7 @@ def conversion(func):
                 print(f"With: {assertion}")
                 print()
 
-            node.replace(assertion)
+            # fissix replaces the node with whatever we return
             return assertion
 
     return wrapper
@@ -251,7 +247,9 @@ def assertmethod_to_assert(node, capture, arguments):
             Call(kw("isinstance"), [arguments[0], Comma(), arguments[1]])
         ]
         if invert:
-            assert_test_nodes.insert(0, kw("not"))
+            assert_test_nodes = [
+                Node(syms.not_test, [kw("not")] + assert_test_nodes)
+            ]
     elif function_name == "assertAlmostEqual":
         arguments[1].prefix = ""
         # TODO: insert the `import pytest` at the top of the file
@@ -300,15 +298,21 @@ def assertmethod_to_assert(node, capture, arguments):
             elif op_tokens[0].type == TOKEN.EQEQUAL:
                 op_tokens[0] = Leaf(TOKEN.NOTEQUAL, "!=", prefix=" ")
 
+        # Build the same nodes the parser would, so other selectors can match them
         if num_arguments == 2:
             # a != b, etc.
-            assert_test_nodes = [arguments[0]] + op_tokens + [arguments[1]]
+            assert_test_nodes = [
+                Node(syms.comparison, [arguments[0]] + op_tokens + [arguments[1]])
+            ]
         elif function_name == "assertTrue":
-            assert_test_nodes = op_tokens + [arguments[0]]
-            # not a
+            if op_tokens:
+                # not a
+                assert_test_nodes = [Node(syms.not_test, op_tokens + [arguments[0]])]
+            else:
+                assert_test_nodes = [arguments[0]]
         elif function_name == "assertIsNone":
             # a is not None
-            assert_test_nodes = [arguments[0]] + op_tokens
+            assert_test_nodes = [Node(syms.comparison, [arguments[0]] + op_tokens)]
 
     return Assert(
         assert_test_nodes, message.clone() if message else None, prefix=node.prefix
@@ -409,10 +413,18 @@ def handle_assertraises(node, capture, arguments):
 
         --> pytest.raises(ValueError, func, arg1)
     """
-    capture['attr1'].replace(
-        kw('pytest', prefix=capture['attr1'].prefix)
+    # Only `self.assertRaises(...)` exactly; not `self.foo.assertRaises(...)`,
+    # nor `self.assertRaises(...).foo`
+    attr1 = node.children[0]
+    if len(node.children) != 3 or not (
+        isinstance(attr1, Leaf) and attr1.value == "self"
+    ):
+        return None
+
+    attr1.replace(
+        kw('pytest', prefix=attr1.prefix)
     )
-    capture['attr2'].replace(
+    capture['method'].replace(
         Node(syms.trailer, [Dot(), kw('raises', prefix='')])
     )
 
@@ -420,6 +432,75 @@ def handle_assertraises(node, capture, arguments):
     touch_import(None, "pytest", node)
 
 
+def _conversion_for(function_name):
+    if SYNONYMS.get(function_name, function_name) == "assertAlmostEqual":
+        return assertalmostequal_to_assert
+    return assertmethod_to_assert
+
+
+# Maps the name of each method we convert to the callback that converts it.
+CONVERSIONS = {
+    function_name: _conversion_for(function_name)
+    for function_name in sorted(set(SYNONYMS) | set(ARGUMENTS) | INVERT_FUNCTIONS)
+}
+CONVERSIONS["assertRaises"] = handle_assertraises
+
+# Finds any of the above method names, without parsing anything
+PREFILTER = re.compile(
+    rb"\b(?:" + b"|".join(name.encode() for name in CONVERSIONS) + rb")\b"
+)
+
+
+# The conversions can be enabled and disabled separately with decrapify.py's
+# --enable/--disable, as parts of the convert_method_call rule,
+# e.g. `convert_method_call:assertTrue`.
+RULE_PARTS = {"convert_method_call": sorted(CONVERSIONS)}
+
+
+def rule_part(node, capture):
+    """
+    Returns which of RULE_PARTS a match is for.
+    """
+    return capture["function_name"].value
+
+
+def is_convertible_method(node, capture, filename):
+    """
+    Filters out calls to methods we don't know how to convert.
+    """
+    return capture["function_name"].value in CONVERSIONS
+
+
+def convert_method_call(node, capture, filename):
+    """
+    Dispatches a selected `self.assertXyz(...)` call to the conversion for that method.
+    """
+    conversion = CONVERSIONS[capture["function_name"].value]
+    return conversion(node, capture, filename)
+
+
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
+        # One selector for every method call we know how to convert, so each call
+        # in the tree only gets matched once. The conversion to apply is then
+        # looked up by method name.
+        .select("""
+            function_call=power<
+                any*
+                method=trailer< "." function_name=NAME >
+                trailer< '(' function_arguments=any* ')' >
+                any*
+            >
+        """)
+        .filter(is_convertible_method)
+        .modify(callback=convert_method_call)
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Converts x-unit style tests to be pytest-style where possible."
@@ -465,64 +546,7 @@ def main():
 
     query = (
         # Look for files in the current working directory
-        Query(*args.files)
-        # NOTE: You can append as many .select().modify() bits as you want to one query.
-        # Each .modify() acts only on the .select[_*]() immediately prior.
-        .select_method("assertEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertEquals")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("failUnlessEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertNotEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("failIfEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIs")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIsNot")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIn")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertNotIn")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertTrue")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assert_")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("failUnless")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertFalse")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("failIf")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIsNone")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIsNotNone")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertGreater")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertGreaterEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertLess")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertLessEqual")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertIsInstance")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertNotIsInstance")
-        .modify(callback=assertmethod_to_assert)
-        .select_method("assertAlmostEqual")
-        .modify(callback=assertalmostequal_to_assert)
-        .select_method("assertNotAlmostEqual")
-        .modify(callback=assertalmostequal_to_assert)
-        .select("""
-            function_call=power<
-                attr1="self" attr2=trailer< "." "assertRaises" >
-                trailer< '(' function_arguments=any* ')' >
-            >
-        """)
-        .modify(callback=handle_assertraises)
+        add_transforms(Query(*args.files))
         # Actually run all of the above.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
@@ -4,6 +4,7 @@ Adds some py2&3 compatibility that modernize/futurize missed
 """
 
 import argparse
+import re
 from fissix.pygram import python_symbols as syms
 from fissix.fixer_util import Name, Dot, Newline, touch_import, find_binding
 
@@ -12,6 +13,9 @@ from bowler.types import Leaf, Node
 
 flags = {}
 
+# Cheap check for whether a file is worth parsing at all
+PREFILTER = re.compile(rb'__unicode__')
+
 
 def replace_unicode_methods(node, capture, arguments):
 
@@ -53,6 +57,28 @@ def replace_unicode_methods(node, capture, arguments):
     node.replace(decorated)
 
 
+def add_transforms(query):
+    """
+    Adds the selectors and modifiers for this script to the given bowler Query.
+    """
+    return (
+        query
+        .select(
+            """
+            classdef<
+                "class" classname=NAME any* ":"
+                suite=suite<
+                    any*
+                    func=funcdef< "def" funcname="__unicode__" parameters< "(" NAME ")" > any*  >
+                    any*
+                >
+            >
+            """
+        )
+        .modify(callback=replace_unicode_methods)
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Adds some py2&3 compatibility that modernize/futurize missed"
@@ -88,20 +114,7 @@ def main():
 
     (
         # Look for files in the current working directory
-        Query(*args.files)
-        .select(
-            """
-            classdef<
-                "class" classname=NAME any* ":"
-                suite=suite<
-                    any*
-                    func=funcdef< "def" funcname="__unicode__" parameters< "(" NAME ")" > any*  >
-                    any*
-                >
-            >
-            """
-        )
-        .modify(callback=replace_unicode_methods)
+        add_transforms(Query(*args.files))
         # Actually run all of the above.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
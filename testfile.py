@@ -201,3 +201,9 @@ def f():
 
     with self.assertRaises(x):
         y()
+
+
+# Statements after a form feed (which doesn't count as indentation)
+form_feed = 'a %s string' % string
+class FormFed(object):
+    pass